@@ -0,0 +1,220 @@
+import argparse
+import random
+import re
+import time
+from array import array
+
+import SAR_cache
+import SAR_posting
+import SAR_query
+import SAR_reader
+from SAR_lib import SAR_Project
+from SAR_posting import Posting
+
+
+def random_posting(size, universe):
+    """
+    Posting list aleatoria (ordenada y sin repetidos) de "size" newids menores que "universe".
+
+    """
+    if SAR_posting.np is not None:
+        rng = SAR_posting.np.random.default_rng(size)
+        newids = rng.choice(universe, size, replace=False)
+        newids.sort()
+        return SAR_posting._from_numpy(newids)
+    return array('I', sorted(random.sample(range(universe), size)))
+
+
+def timeit(fnc, *args, repeat=1):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fnc(*args)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def bench_engines(args):
+    """
+    Compara los motores de AND/OR/NOT (SAR_Project.set_engine) con posting lists
+    de 10^min_exp a 10^max_exp elementos, con tamaños iguales y muy descompensados.
+
+    """
+    project = SAR_Project()
+    engines = ["merge"] + list(SAR_posting.ENGINES)
+    operations = (("AND", "and_posting"), ("OR", "or_posting"), ("AND NOT", "minus_posting"))
+
+    print("%-10s %-10s %-8s" % ("|p1|", "|p2|", "op") +
+            ''.join("%12s" % engine for engine in engines))
+
+    for exp in range(args.min_exp, args.max_exp + 1):
+        size = 10 ** exp
+        universe = 4 * size
+        big = random_posting(size, universe)
+        for small_size in sorted(set((size, max(1, size // 1000)))):
+            small = random_posting(small_size, universe)
+            for name, method in operations:
+                times = []
+                reference = None
+                for engine in engines:
+                    project.set_engine(engine)
+                    elapsed, result = timeit(getattr(project, method), big, small, repeat=args.repeat)
+                    if reference is None:
+                        reference = result
+                    elif result != reference:
+                        raise AssertionError(f"'{engine}' da un resultado distinto en {name}")
+                    times.append(elapsed)
+                print("%-10d %-10d %-8s" % (size, small_size, name) +
+                        ''.join("%11.4fs" % t for t in times))
+
+
+def bench_skips(args):
+    """
+    Compara el AND de una posting corta con una larga recorriendo la larga elemento
+    a elemento (merge) y saltando con sus skip pointers.
+
+    """
+    project = SAR_Project()
+    print("%-10s %-10s %12s %12s %10s" % ("|big|", "|small|", "merge", "skips", "speedup"))
+
+    for exp in range(args.min_exp, args.max_exp + 1):
+        size = 10 ** exp
+        universe = 4 * size
+        big = Posting(random_posting(size, universe))
+        big.make_skips()
+        for small_exp in range(1, exp):
+            small = random_posting(10 ** small_exp, universe)
+            merge, reference = timeit(project.and_posting, small, big.newids, repeat=args.repeat)
+            skips, result = timeit(project.and_posting, small, big, repeat=args.repeat)
+            if result != reference:
+                raise AssertionError("los skip pointers dan un resultado distinto")
+            print("%-10d %-10d %11.4fs %11.4fs %9.1fx" % (size, len(small), merge, skips, merge / skips))
+
+
+def bench_tokenizer(args):
+    """
+    Compara la tokenizacion anterior (sustituir "\W+" por espacios y dividir) con
+    SAR_Project.tokenize sobre los articulos de "news".
+
+    """
+    project = SAR_Project()
+    texts = [news["article"] for filename in project.list_files(args.news)
+                for news in SAR_reader.read_news(filename)]
+    nchars = sum(map(len, texts))
+
+    separators = re.compile(r"\W+")
+    methods = (
+        ("sub + split", lambda: [separators.sub(' ', text.lower()).split() for text in texts]),
+        ("tokenize", lambda: [project.tokenize(text) for text in texts]),
+    )
+
+    print(f"{len(texts)} articles, {nchars / 1e6:.1f}M characters")
+    print("%-16s %10s %12s" % ("method", "time", "Mchars/s"))
+    reference = None
+    for name, fnc in methods:
+        elapsed, result = timeit(fnc, repeat=args.repeat)
+        if reference is None:
+            reference = result
+        elif result != reference:
+            raise AssertionError(f"'{name}' da tokens distintos")
+        print("%-16s %9.3fs %12.1f" % (name, elapsed, nchars / elapsed / 1e6))
+
+
+def bench_queries(args):
+    """
+    Comprueba y mide las queries de un fichero (como los de -L y -T) resueltas sin cache,
+    con SAR_Project.query_cache y con SAR_Project.solve_batch, que deben dar lo mismo.
+
+    Antes de las del fichero se añaden, para parejas de sus terminos, "a AND b", "a OR b",
+    "NOT (a OR b)"... seguidas: comparten operandos y la cache no debe confundirlas.
+
+    """
+    project = SAR_Project.load(args.index)
+    project.set_stemming(args.stem)
+    with open(args.queries, encoding='utf-8') as fh:
+        queries = [line.split('\t')[0] for line in fh.read().split('\n')
+                    if len(line) > 0 and not line.startswith('#')]
+
+    terms = []
+    for query in queries:
+        try:
+            node = project.parse_query(query)
+        except SAR_query.QuerySyntaxError:
+            continue
+        for field, term in SAR_query.positive_terms(node):
+            if(field == "article" and term not in terms):
+                terms.append(term)
+    checks = []
+    for a, b in zip(terms[:args.terms], terms[1:args.terms]):
+        checks.extend((f"{a} AND {b}", f"{a} OR {b}", f"NOT ({a} OR {b})", f"NOT ({a} AND {b})",
+                       f"{a} AND NOT {b}", f"{b} AND NOT {a}", f"{b} OR {a}"))
+    queries = checks + queries
+
+    def solve_all():
+        return [project.solve_query(query) for query in queries]
+
+    def new_cache(maxsize):
+        return SAR_cache.LRUCache(maxsize, project.CACHE_WEIGHTS["query_cache"])
+
+    # referencia: una cache que no guarda nada
+    project.query_cache = new_cache(0)
+    reference = timeit(solve_all)
+    project.query_cache = new_cache(project.CACHES["query_cache"])
+    cached = timeit(solve_all)
+    cache = project.query_cache
+    project.query_cache = new_cache(project.CACHES["query_cache"])
+    batch = timeit(project.solve_batch, queries)
+
+    print(f"{len(queries)} queries ({len(checks)} AND/OR/NOT checks)")
+    print("%-16s %10s" % ("method", "time"))
+    for name, (elapsed, result) in (("no cache", reference), ("query_cache", cached), ("solve_batch", batch)):
+        for query, got, expected in zip(queries, result, reference[1]):
+            if(list(got) != list(expected)):
+                raise AssertionError(f"'{name}' da {len(got)} resultados en '{query}', sin cache {len(expected)}")
+        print("%-16s %9.3fs" % (name, elapsed))
+    print(f"query_cache hit rate {cache.hit_rate():.1%}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Microbenchmarks of SAR_lib.')
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    engines = subparsers.add_parser('engines', help='compare the AND/OR/NOT engines.')
+    engines.add_argument('--min-exp', dest='min_exp', type=int, default=3,
+                    help='smallest posting size, as a power of 10.')
+    engines.add_argument('--max-exp', dest='max_exp', type=int, default=7,
+                    help='largest posting size, as a power of 10.')
+    engines.add_argument('--repeat', dest='repeat', type=int, default=3,
+                    help='repetitions of each measure, the best one is shown.')
+    engines.set_defaults(fnc=bench_engines)
+
+    skips = subparsers.add_parser('skips', help='AND of skewed postings with and without skip pointers.')
+    skips.add_argument('--min-exp', dest='min_exp', type=int, default=4,
+                    help='smallest size of the long posting, as a power of 10.')
+    skips.add_argument('--max-exp', dest='max_exp', type=int, default=7,
+                    help='largest size of the long posting, as a power of 10.')
+    skips.add_argument('--repeat', dest='repeat', type=int, default=3,
+                    help='repetitions of each measure, the best one is shown.')
+    skips.set_defaults(fnc=bench_skips)
+
+    tokenizer = subparsers.add_parser('tokenizer', help='tokenize the articles of a directory of news.')
+    tokenizer.add_argument('news', metavar='news', type=str,
+                    help='directory with the news (e.g. a month).')
+    tokenizer.add_argument('--repeat', dest='repeat', type=int, default=3,
+                    help='repetitions of each measure, the best one is shown.')
+    tokenizer.set_defaults(fnc=bench_tokenizer)
+
+    queries = subparsers.add_parser('queries', help='check and time a query file with and without caches.')
+    queries.add_argument('index', metavar='index', type=str,
+                    help='name of the file with the index object.')
+    queries.add_argument('queries', metavar='queries', type=str,
+                    help='file with queries, one per line (a -T file is also valid).')
+    queries.add_argument('-S', '--stem', dest='stem', action='store_true', default=False,
+                    help='use stem index.')
+    queries.add_argument('--terms', dest='terms', type=int, default=6,
+                    help='terms of the file combined with AND/OR/NOT before its queries.')
+    queries.set_defaults(fnc=bench_queries)
+
+    args = parser.parse_args()
+    args.fnc(args)
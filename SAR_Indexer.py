@@ -1,5 +1,5 @@
 import argparse
-import pickle
+import os
 import sys
 import time
 
@@ -21,23 +21,37 @@ if __name__ == "__main__":
     parser.add_argument('-P', '--permuterm', dest='permuterm', action='store_true', default=False,
                     help='compute permuterm index.')
 
+    parser.add_argument('-F', '--fuzzy', dest='fuzzy', action='store_true', default=False,
+                    help='compute k-gram index for fuzzy (term~k) queries.')
+
     parser.add_argument('-M', '--multifield', dest='multifield', action='store_true', default=False, 
                     help='compute index for all the fields.')
 
     parser.add_argument('-O', '--positional', dest='positional', action='store_true', default=False, 
                     help='compute positional index.')
 
+    parser.add_argument('-W', '--workers', dest='workers', type=int, default=1,
+                    help='number of processes used to index the news.')
+
+    parser.add_argument('-A', '--append', dest='append', action='store_true', default=False,
+                    help='add only the new files of newsdir to an existing index.')
+
     args = parser.parse_args()
 
     newsdir = args.newsdir
     indexfile = args.index
 
-    indexer = SAR_Project()
     t0 = time.time()
-    indexer.index_dir(newsdir, **vars(args))
+    if args.append and os.path.exists(indexfile):
+        indexer = SAR_Project.load(indexfile)
+        indexer.materialize()
+        added = indexer.append_dir(newsdir, **vars(args))
+        print("Appended %d new files." % len(added))
+    else:
+        indexer = SAR_Project()
+        indexer.index_dir(newsdir, **vars(args))
     t1 = time.time()
-    with open(indexfile, 'wb') as fh:
-            pickle.dump(indexer, fh)
+    indexer.save(indexfile)
     t2 = time.time()
     indexer.show_stats()
     print("Time indexing: %2.2fs." % (t1 - t0))
@@ -2,9 +2,9 @@
 
 
 import argparse
-import pickle
 import sys
 
+import SAR_posting
 from SAR_lib import SAR_Project
 
 
@@ -40,6 +40,20 @@ if __name__ == "__main__":
     parser.add_argument('-R', '--rank', dest='rank', action='store_true', default=False, 
                     help='rank results. Does not apply with -C and -T options.')
 
+    parser.add_argument('-M', '--model', dest='model', type=str, default='bm25',
+                    choices=SAR_Project.RANKINGS,
+                    help='ranking model used with -R.')
+
+    parser.add_argument('-X', '--explain', dest='explain', action='store_true', default=False,
+                    help='show the plan chosen for each query before solving it.')
+
+    parser.add_argument('-E', '--engine', dest='engine', type=str, default='merge',
+                    choices=('merge',) + tuple(SAR_posting.ENGINES),
+                    help='engine used for the AND/OR/NOT operations on posting lists.')
+
+    parser.add_argument('-K', '--cache-stats', dest='cache_stats', action='store_true', default=False,
+                    help='show the use of the caches after solving the queries.')
+
 
     group1 = parser.add_mutually_exclusive_group()
     group1.add_argument('-Q', '--query', dest='query', metavar= 'query', type=str, action='store',
@@ -51,13 +65,13 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    with open(args.index, 'rb') as fh:
-        searcher = pickle.load(fh)
+    searcher = SAR_Project.load(args.index)
 
     searcher.set_stemming(args.stem)
-    searcher.set_ranking(args.rank)
+    searcher.set_ranking(args.model if args.rank else False)
     searcher.set_showall(args.all)
     searcher.set_snippet(args.snippet)
+    searcher.set_engine(args.engine)
 
 
     # se debe contar o mostrar resultados?
@@ -66,6 +80,13 @@ if __name__ == "__main__":
     else:
         fnc = searcher.solve_and_show
 
+    # se debe mostrar el plan de cada query?
+    if args.explain is True:
+        solve = fnc
+        def fnc(query):
+            print(searcher.explain(query))
+            return solve(query)
+
     # El try es para recordar volver a lanzar Indexer en
     # caso de error
     error = False
@@ -75,11 +96,15 @@ if __name__ == "__main__":
 
             with open(args.test, encoding='utf-8') as fh:
                 lines = fh.read().split('\n')
+                # todas las queries del fichero se resuelven en un solo lote
+                tests = [line.split('\t') for line in lines if len(line) > 0 and not line.startswith('#')]
+                results = iter(searcher.solve_batch([query for query, _ in tests]))
                 for line in lines:
                     if len(line) > 0 and not line.startswith('#'):
                         query, reference = line.split('\t')
                         reference = int(reference)
-                        result = searcher.solve_and_count(query)
+                        result = len(next(results))
+                        print("%s\t%d" % (query, result))
                         if result != reference:
                             print("==> ERROR: '%s'\t%d\t%d" % (query, result, reference))
                             sys.exit(-1)
@@ -107,6 +132,9 @@ if __name__ == "__main__":
             while query != "":
                 fnc(query)
                 query = input("query:")
+
+        if args.cache_stats is True:
+            searcher.show_cache_stats()
     except Exception as e:
         error = True
         raise e
@@ -0,0 +1,111 @@
+"""
+Caches de SAR_Project.
+
+"""
+
+import sys
+from collections import OrderedDict
+
+
+def sizeof(value):
+    """
+    Tamaño aproximado en bytes de "value" y de los elementos que contiene directamente:
+    los de una tupla o lista, las claves y valores de un diccionario, o los atributos de
+    un objeto con __slots__ (como SAR_posting.Posting).
+
+    """
+    size = sys.getsizeof(value)
+    if(isinstance(value, (tuple, list))):
+        size += sum(map(sys.getsizeof, value))
+    elif(isinstance(value, dict)):
+        size += sum(map(sys.getsizeof, value)) + sum(map(sys.getsizeof, value.values()))
+    elif(hasattr(type(value), "__slots__")):
+        size += sum(sys.getsizeof(getattr(value, name)) for name in type(value).__slots__)
+    return size
+
+
+
+class LRUCache:
+    """
+    Diccionario de tamaño maximo "maxsize": al llenarse se descarta el elemento
+    usado hace mas tiempo. Cuenta los aciertos y fallos de "get".
+
+    Por defecto el tamaño es el numero de elementos; si se da "weight", es la suma de
+    weight(valor) de los elementos (por ejemplo bytes, con "sizeof").
+
+    """
+
+    def __init__(self, maxsize=1024, weight=None):
+        self.maxsize = maxsize
+        self.weight = weight
+        self.size = 0 # suma de weight(valor), solo si hay "weight"
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+    def __contains__(self, key):
+        return key in self.data
+
+
+    def get(self, key, default=None):
+        """
+        Devuelve el valor de "key" (y lo marca como el ultimo usado) o "default" si no esta.
+
+        """
+        try:
+            self.data.move_to_end(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return self.data[key]
+
+
+    def __setitem__(self, key, value):
+        data = self.data
+        weight = self.weight
+        if(weight is None):
+            data[key] = value
+            data.move_to_end(key)
+            if(len(data) > self.maxsize):
+                data.popitem(last=False)
+            return
+
+        if(key in data):
+            self.size -= weight(data[key])
+        data[key] = value
+        data.move_to_end(key)
+        self.size += weight(value)
+        while self.size > self.maxsize and data:
+            _, old = data.popitem(last=False)
+            self.size -= weight(old)
+
+
+    def update(self, other):
+        """
+        Añade los elementos de la cache "other" y suma sus aciertos y fallos.
+
+        """
+        for key, value in other.data.items():
+            self[key] = value
+        self.hits += other.hits
+        self.misses += other.misses
+
+
+    def clear(self):
+        self.data.clear()
+        self.size = 0
+
+
+    def hit_rate(self):
+        """
+        Fraccion de llamadas a "get" que han encontrado el valor.
+
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
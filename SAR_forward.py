@@ -0,0 +1,104 @@
+"""
+Indice directo (noticia -> terminos) de SAR_Project, uno por campo.
+
+Cada noticia es un vector de pares (id del termino, frecuencia) ordenado por id. Los vectores
+de todas las noticias estan seguidos en dos arrays, y una tabla de offsets indexada por newid
+indica donde empieza cada uno:
+
+    offsets:    offsets[newid] .. offsets[newid + 1] es el rango de la noticia en tids y tfs
+    tids:       ids de los terminos (SAR_vocab.Vocabulary)
+    tfs:        frecuencia de cada termino en la noticia
+
+Las noticias se añaden en orden de newid; las que no tienen terminos en el campo quedan vacias.
+Al ser arrays, se guardan con pickle como un volcado directo de su memoria.
+
+"""
+
+from array import array
+
+
+class ForwardIndex:
+    """
+    Vectores (id del termino, frecuencia) de las noticias de un campo.
+
+    """
+
+    def __init__(self):
+        self.offsets = array('I', [0])
+        self.tids = array('I')
+        self.tfs = array('I')
+
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+    def add(self, newid, counts):
+        """
+        Añade el vector de la noticia "newid", que debe ser mayor que las ya añadidas.
+
+        param:  "newid": noticia
+                "counts": {id del termino: frecuencia}
+
+        """
+        offsets = self.offsets
+        end = offsets[-1]
+        while len(offsets) <= newid:
+            offsets.append(end)
+
+        for tid in sorted(counts):
+            self.tids.append(tid)
+            self.tfs.append(counts[tid])
+        offsets.append(len(self.tids))
+
+
+    def seek(self, newid):
+        """
+        Posicion en tids y tfs donde empieza la noticia "newid" (o el final si no esta).
+
+        """
+        offsets = self.offsets
+        return offsets[newid] if newid < len(offsets) else offsets[-1]
+
+
+    def terms(self, newid):
+        """
+        Ids de los terminos de la noticia "newid", ordenados.
+
+        """
+        return self.tids[self.seek(newid):self.seek(newid + 1)]
+
+
+    def vector(self, newid):
+        """
+        Pares (id del termino, frecuencia) de la noticia "newid", ordenados por id.
+
+        """
+        lo = self.seek(newid)
+        hi = self.seek(newid + 1)
+        return zip(self.tids[lo:hi], self.tfs[lo:hi])
+
+
+    def length(self, newid):
+        """
+        Numero de tokens de la noticia "newid" en el campo.
+
+        """
+        return sum(self.tfs[self.seek(newid):self.seek(newid + 1)])
+
+
+    def extend(self, other, newid_off, tids):
+        """
+        Añade las noticias de "other" (indice de un shard) a partir de "newid_off".
+
+        param:  "other": ForwardIndex del shard
+                "newid_off": newid que corresponde a la primera noticia de "other"
+                "tids": lista que traduce los ids del vocabulario de "other" a los de este indice
+
+        """
+        for newid in range(len(other)):
+            lo = other.offsets[newid]
+            hi = other.offsets[newid + 1]
+            if(lo < hi):
+                self.add(newid + newid_off,
+                         dict(zip((tids[tid] for tid in other.tids[lo:hi]), other.tfs[lo:hi])))
@@ -0,0 +1,210 @@
+"""
+Indice de k-gramas de SAR_Project, para buscar terminos con erratas (consultas "termino~k").
+
+Cada termino se rodea de "$" y se parte en trigramas ("casa": $ca cas asa sa$). Para cada
+trigrama y longitud de termino se guarda la lista de ids de los terminos que lo contienen y la
+posicion del trigrama en cada uno, asi una busqueda solo recorre los terminos de longitud
+compatible con la distancia pedida.
+
+Una edicion cambia como mucho K trigramas, por lo que un termino a distancia d o menos de "q"
+comparte al menos m = (numero de trigramas de q) - K*d trigramas con el. Ademas, un trigrama
+que ninguna edicion ha tocado solo se desplaza tantas posiciones como inserciones y borrados
+haya antes que el, y con la longitud del termino se sabe cuantos hay en total: de cada lista
+solo cuentan las posiciones compatibles (con d = 1 y la misma longitud, solo la misma posicion).
+El termino tiene que estar en alguna de las n - m + 1 listas mas cortas de los n trigramas de q:
+solo se recorren esas (y una mas), y el resto se consultan con busqueda binaria para los
+candidatos. Los que llegan al minimo se comprueban con la distancia de Levenshtein (acotada).
+
+Con terminos de K*d caracteres o menos el minimo no es positivo y el filtro no descarta nada:
+se comprueban todos los terminos de longitud compatible. Con un vocabulario de un millon de
+terminos, "termino~1" tarda menos de un milisegundo y "termino~2" unas decenas (muchos terminos
+pasan el filtro), pero con terminos de 3 caracteres o menos ("~1") o de 6 o menos ("~2") el
+tiempo crece con el vocabulario: decenas de milisegundos o segundos.
+
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from itertools import compress
+
+
+K = 3
+# posicion maxima guardada: las de terminos mas largos se guardan como MAX_POS,
+# que encaja con cualquier posicion de la busqueda
+MAX_POS = 255
+
+
+def kgrams(term):
+    """
+    Lista de (posicion, k-grama) de "term" rodeado de "$".
+
+    """
+    padded = "$" + term + "$"
+    return [(i, padded[i:i + K]) for i in range(max(1, len(padded) - K + 1))]
+
+
+def _window(lo, hi):
+    """
+    Tabla de bytes.translate que marca con 1 las posiciones de "lo" a "hi" (y MAX_POS).
+
+    """
+    table = bytearray(MAX_POS + 1)
+    lo = max(0, lo)
+    hi = min(MAX_POS, hi + 1)
+    table[lo:hi] = b"\1" * (hi - lo)
+    table[MAX_POS] = 1
+    return bytes(table)
+
+
+def levenshtein(a, b, bound):
+    """
+    Distancia de edicion entre "a" y "b", dejando de calcular en cuanto supera "bound".
+
+    return: la distancia, o bound + 1 si es mayor que "bound"
+
+    """
+    if(abs(len(a) - len(b)) > bound):
+        return bound + 1
+
+    # el prefijo y el sufijo comunes no cambian la distancia
+    size = min(len(a), len(b))
+    prefix = 0
+    while prefix < size and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < size - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    a = a[prefix:len(a) - suffix]
+    b = b[prefix:len(b) - suffix]
+    if(not a or not b):
+        return min(len(a) + len(b), bound + 1)
+
+    # solo hace falta la banda |i - j| <= bound de la matriz, fuera vale mas que "bound"
+    over = bound + 1
+    previous = [j if j <= bound else over for j in range(len(b) + 1)]
+    for i, char_a in enumerate(a, 1):
+        lo = max(1, i - bound)
+        hi = min(len(b), i + bound)
+        current = [over] * (len(b) + 1)
+        if(i <= bound):
+            current[0] = i
+        best = current[0]
+        for j in range(lo, hi + 1):
+            cost = previous[j - 1] + (char_a != b[j - 1])
+            if(previous[j] + 1 < cost):
+                cost = previous[j] + 1
+            if(current[j - 1] + 1 < cost):
+                cost = current[j - 1] + 1
+            current[j] = cost
+            if(cost < best):
+                best = cost
+        if(best > bound):
+            return over
+        previous = current
+    return min(previous[-1], over)
+
+
+
+class KGramIndex:
+    """
+    Indice de k-gramas de los terminos de un campo.
+
+        - terms: lista de terminos, el id de un termino es su posicion
+        - postings: {(k-grama, longitud del termino): (array con los ids de los terminos,
+                     bytearray con la posicion del k-grama en cada uno)}, por id
+        - by_length: {longitud: array con los ids de los terminos}, para los terminos tan
+                     cortos que el filtro de k-gramas no descarta nada
+
+    """
+
+    def __init__(self, terms=()):
+        self.terms = []
+        self.postings = {}
+        self.by_length = {}
+        self.add(terms)
+
+
+    def __len__(self):
+        return len(self.postings)
+
+
+    def add(self, terms):
+        """
+        Añade al indice los terminos de "terms" que no esten ya.
+
+        """
+        postings = self.postings
+        for term in sorted(set(terms).difference(self.terms)):
+            tid = len(self.terms)
+            self.terms.append(term)
+            size = len(term)
+            for pos, gram in kgrams(term):
+                key = (gram, size)
+                entry = postings.get(key)
+                if entry is None:
+                    postings[key] = entry = (array('I'), bytearray())
+                entry[0].append(tid)
+                entry[1].append(min(pos, MAX_POS))
+            ids = self.by_length.get(size)
+            if ids is None:
+                self.by_length[size] = ids = array('I')
+            ids.append(tid)
+
+
+    def lookup(self, term, distance=1):
+        """
+        Terminos a distancia de edicion "distance" o menos de "term".
+
+        param:  "term": termino buscado
+                "distance": numero maximo de inserciones, borrados o sustituciones
+
+        return: lista ordenada de terminos
+
+        """
+        grams = kgrams(term)
+        need = len(grams) - K * distance
+        terms = self.terms
+        empty = (array('I'), bytearray())
+
+        candidates = []
+        for size in range(max(1, len(term) - distance), len(term) + distance + 1):
+            if(need <= 0): # cualquier termino de esta longitud puede estar a "distance"
+                candidates.extend(self.by_length.get(size, ()))
+                continue
+
+            # desplazamiento de un trigrama sin editar: entre 0 y el de la longitud,
+            # y mas alla solo con las ediciones que sobren (un paso de ida y otro de vuelta)
+            shift = size - len(term)
+            slack = (distance - abs(shift)) // 2
+            lo, hi = min(0, shift) - slack, max(0, shift) + slack
+            lists = sorted((self.postings.get((gram, size), empty) + (_window(pos + lo, pos + hi),)
+                            for pos, gram in grams), key=lambda entry: len(entry[0]))
+
+            # se recorre una lista mas de las necesarias: los que solo estan en una no llegan
+            # al minimo y se descartan sin busquedas binarias. Un trigrama repetido puede
+            # contar dos veces: el filtro es algo menos estricto, pero no deja fuera a nadie
+            extra = 1 if need > 1 else 0
+            scan = len(lists) - need + 1 + extra
+            counts = Counter()
+            for ids, positions, window in lists[:scan]:
+                counts.update(compress(ids, positions.translate(window)))
+
+            rest = lists[scan:]
+            for tid, count in counts.items():
+                if(count <= extra):
+                    continue
+                for nlist, (ids, positions, window) in enumerate(rest):
+                    if(count >= need or count + len(rest) - nlist < need):
+                        break
+                    i = bisect_left(ids, tid)
+                    while i < len(ids) and ids[i] == tid:
+                        if(window[positions[i]]):
+                            count += 1
+                            break
+                        i += 1
+                if(count >= need):
+                    candidates.append(tid)
+
+        return sorted(terms[tid] for tid in candidates
+                        if levenshtein(term, terms[tid], distance) <= distance)
@@ -1,13 +1,29 @@
-import json
 import os
 import re
+import multiprocessing
+import time
 import nltk
 from nltk.stem.snowball import SnowballStemmer
 from nltk .corpus import wordnet
-from collections import defaultdict
+from array import array
+from collections import Counter, defaultdict
+from heapq import nlargest
+from itertools import accumulate, groupby, islice
 from typing import Dict
-from math import log2
-from operator import itemgetter
+from math import log, log2, sqrt
+from operator import itemgetter, mul, sub
+
+from SAR_posting import Posting
+import SAR_cache
+import SAR_forward
+import SAR_kgram
+import SAR_permuterm
+import SAR_posting
+import SAR_query
+import SAR_reader
+import SAR_segment
+import SAR_snippet
+import SAR_vocab
 
 """
 try:
@@ -51,7 +67,44 @@ class SAR_Project:
     # numero maximo de documento a mostrar cuando self.show_all es False
     SHOW_MAX = 10
 
-    iindex:Dict[int, defaultdict]
+    # and_posting usa los skip pointers cuando una lista es este numero de veces mas corta que la otra
+    SKIP_RATIO = 8
+
+    # estructuras que el segmento guarda aparte y que solo se cargan al usarlas
+    SEGMENT_BLOBS = ("vocab", "iindex", "weight", "freq", "norms",
+                     "ptindex", "kgindex", "stem_cache")
+
+    # caches (SAR_cache.LRUCache) y su tamaño maximo; las que no estan en SEGMENT_BLOBS
+    # no se guardan con el indice, y todas se crean al usarlas si no existen.
+    # query_cache: subconsulta -> (posting list, segundos que costo), ver self.evaluate
+    CACHES = {"wildcard_cache": 1024, "stem_cache": 1 << 18, "query_cache": 32 << 20}
+
+    # caches cuyo tamaño no es el numero de elementos: funcion que da el tamaño de un valor
+    CACHE_WEIGHTS = {"query_cache": SAR_cache.sizeof}
+
+    # version del indice, post_indexing la incrementa cada vez que cambia (al indexar o
+    # añadir noticias) y las entradas de query_cache de versiones anteriores ya no se usan
+    generation = 0
+
+    # segundos ahorrados por los aciertos de query_cache
+    query_time_saved = 0.0
+
+    # mientras solve_batch resuelve un lote de queries: Posting de cada (campo, termino) ya
+    # leido, y mascaras de posiciones (SAR_posting.position_masks) para las frases. Son
+    # SAR_cache.LRUCache de BATCH_MEMORY bytes como maximo cada una
+    batch_postings = None
+    batch_masks = None
+    BATCH_MEMORY = 128 << 20
+
+    # modelos de ranking (ver set_ranking): BM25, TF-IDF con normalizacion del coseno,
+    # y "weight", el pesado por parejas de terminos consecutivos de self.weight
+    RANKINGS = ("bm25", "tfidf", "weight")
+
+    # parametros de BM25
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    iindex:Dict[str, SAR_forward.ForwardIndex]
 
     def __init__(self):
         """
@@ -63,24 +116,32 @@ class SAR_Project:
 
         """
         self.index = dict(((field,{}) for field, _ in self.fields)) 
-        # hash para el indice invertido de terminos --> clave: termino, valor: posting list.
+        # hash para el indice invertido de terminos --> clave: termino, valor: posting list (SAR_posting.Posting).
                         # Si se hace la implementacion multifield, se pude hacer un segundo nivel de hashing de tal forma que:
                         # self.index['title'] seria el indice invertido del campo 'title'.
-        self.iindex = dict(((field,defaultdict(lambda:defaultdict(list))) for field, _ in self.fields))
-        # hash para termino -> clave
+        self.vocab = SAR_vocab.Vocabulary() # vocabulario global, id entero de cada termino y stem
+        self.iindex = dict(((field,SAR_forward.ForwardIndex()) for field, _ in self.fields))
+        # indice directo (SAR_forward.ForwardIndex) de cada campo: newid -> (id del termino, frecuencia)
         self.sindex = dict(((field,{}) for field, _ in self.fields)) # hash para el indice invertido de stems --> clave: stem, valor: lista con los terminos que tienen ese stem
-        self.ptindex = dict(((field,defaultdict(set)) for field, _ in self.fields)) # hash para el indice permuterm.
-        self.ptindex_strict = dict(((field,defaultdict(set)) for field, _ in self.fields)) # hash para el indice permuterm.
-        self.docs = {} # diccionario de documentos --> clave: entero(docid),  valor: ruta del fichero.
-        self.weight = defaultdict(lambda: defaultdict(lambda: [0,0])) # hash de terminos para el pesado, ranking de resultados. puede no utilizarse
-        self.freq = defaultdict(int)
+        self.ptindex = dict(((field,SAR_permuterm.Permuterm()) for field, _ in self.fields)) # indice permuterm (SAR_permuterm.Permuterm) de cada campo.
+        self.kgindex = dict(((field,SAR_kgram.KGramIndex()) for field, _ in self.fields)) # indice de k-gramas (SAR_kgram.KGramIndex) de cada campo, para "termino~k".
+        self.docs = {} # diccionario de documentos --> clave: entero(docid),  valor: (ruta absoluta del fichero, mtime en ns, tamaño)
+        self.weight = defaultdict(lambda: defaultdict(lambda: [0,0])) # hash de ids de terminos para el pesado, ranking de resultados. puede no utilizarse
+        self.freq = defaultdict(int) # id del termino -> numero de apariciones en los articulos
+        self.norms = dict((model, {}) for model in ("bm25", "tfidf")) # modelo -> campo -> array con la normalizacion de cada newid, se crea con self.make_norms()
+        self.min_norms = dict((model, {}) for model in ("bm25", "tfidf")) # modelo -> campo -> menor normalizacion de una noticia, para las cotas de rank_top
+        self.snippets = {} # newid -> articulo comprimido (SAR_snippet.encode), para los snippets
         self.news = {} # hash de noticias --> clave entero (newid), valor: la info necesaria para diferenciar la noticia dentro de su fichero (doc_id y posición dentro del documento)
-        self.tokenizer = re.compile("\W+") # expresion regular para hacer la tokenizacion
+        self.universe = None # bitmap con todos los newid, se crea con self.make_universe()
+        self.tokenizer = re.compile(r"\w+") # expresion regular de un token, para hacer la tokenizacion
         self.stemmer = SnowballStemmer('spanish') # stemmer en castellano
+        self.stem_cache = SAR_cache.LRUCache(self.CACHES["stem_cache"]) # termino -> stem, se usa con self.stem()
         self.show_all = False # valor por defecto, se cambia con self.set_showall()
         self.show_snippet = False # valor por defecto, se cambia con self.set_snippet()
         self.use_stemming = False # valor por defecto, se cambia con self.set_stemming()
         self.use_ranking = False  # valor por defecto, se cambia con self.set_ranking()
+        self.ranking = "bm25" # modelo de ranking por defecto, se cambia con self.set_ranking()
+        self.engine = "merge" # valor por defecto, se cambia con self.set_engine()
         self.docid = 0
         self.newid = 0
         self.num_days = {}
@@ -91,16 +152,95 @@ class SAR_Project:
     def __getstate__(self):
         data = self.__dict__
         
-        data["iindex"] = dict(
-                (key1, dict((
-                    (key2, dict((
-                        (key3, val3) for key3, val3 in val2.items())))
-                    for key2, val2 in val1.items()))) 
-                for key1, val1 in data["iindex"].items())
         data["weight"] = dict((key1, dict((key2, val2) for key2, val2 in val1.items())) for key1, val1 in data["weight"].items())
 
         return data
 
+
+    def __getattr__(self, name):
+        # Solo se llama cuando el atributo no existe: si el indice se ha
+        # cargado de un segmento, las estructuras grandes se leen del
+        # disco la primera vez que se utilizan
+        segment = self.__dict__.get("segment")
+        if(segment is not None and name in segment.blobs):
+            value = segment.load_blob(name)
+        elif(name in self.CACHES):
+            value = SAR_cache.LRUCache(self.CACHES[name], self.CACHE_WEIGHTS.get(name))
+        else:
+            raise AttributeError(name)
+
+        setattr(self, name, value)
+        return value
+
+
+    def save(self, filename):
+        """
+        Guarda el indice en "filename" con el formato de SAR_segment.
+
+        param:  "filename": fichero de salida
+
+        """
+        state = dict(self.__getstate__())
+        index = state.pop("index")
+        sindex = state.pop("sindex")
+        news = state.pop("news")
+        snippets = state.pop("snippets")
+        blobs = dict((name, state.pop(name)) for name in self.SEGMENT_BLOBS)
+        for name in self.CACHES:
+            state.pop(name, None)
+        state.pop("query_time_saved", None)
+
+        SAR_segment.write_segment(filename, state, index, sindex, news, snippets, blobs)
+
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Abre un indice guardado con "save".
+
+        El fichero se abre con mmap y solo se lee su directorio, las posting lists y noticias
+        se decodifican al consultarlas. Los indices de versiones anteriores (los guardados con
+        pickle y los segmentos de otro formato) dan un ValueError: hay que volver a crearlos.
+
+        param:  "filename": fichero del indice
+
+        return: SAR_Project listo para buscar
+
+        """
+        segment = SAR_segment.Segment(filename)
+        project = cls.__new__(cls)
+        project.__dict__.update(segment.state)
+        project.segment = segment
+        project.index = segment.index
+        project.sindex = segment.sindex
+        project.news = segment.news
+        project.snippets = segment.snippets
+        return project
+
+
+    def materialize(self):
+        """
+        Pasa a memoria todas las estructuras de un indice abierto con "load" y cierra su segmento,
+        para poder seguir indexando en el (ver append_dir) y volver a guardarlo en el mismo fichero.
+
+        """
+        segment = self.__dict__.pop("segment", None)
+        if(segment is not None):
+            for name in self.SEGMENT_BLOBS:
+                if(name not in self.__dict__):
+                    setattr(self, name, segment.load_blob(name))
+            self.index = dict((field, dict(token_dict.items())) for field, token_dict in self.index.items())
+            self.sindex = dict((field, dict(token_dict.items())) for field, token_dict in self.sindex.items())
+            self.news = dict(self.news.items())
+            self.snippets = dict(self.snippets.items())
+            segment.close()
+
+        # __getstate__ guarda weight como diccionarios normales, index_file necesita los defaultdict
+        weight = defaultdict(lambda: defaultdict(lambda: [0,0]))
+        for token, other_dict in self.weight.items():
+            weight[token].update(other_dict)
+        self.weight = weight
+
     ###############################
     ###                         ###
     ###      CONFIGURACION      ###
@@ -158,16 +298,36 @@ class SAR_Project:
 
         Cambia el modo de ranking por defecto.
         
-        input: "v" booleano.
+        input: "v" booleano, o el nombre de uno de self.RANKINGS para activar el ranking con ese modelo.
 
         UTIL PARA LA VERSION CON RANKING DE NOTICIAS
 
         si self.use_ranking es True las consultas se mostraran ordenadas, no aplicable a la opcion -C
 
         """
+        if(isinstance(v, str)):
+            if(v not in self.RANKINGS):
+                raise ValueError(f"Modelo de ranking desconocido: '{v}'")
+            self.ranking = v
+            v = True
         self.use_ranking = v
 
 
+    def set_engine(self, v):
+        """
+
+        Cambia el motor de operaciones AND/OR/NOT sobre posting lists.
+
+        input: "v" nombre del motor: "merge" (por defecto) o uno de SAR_posting.ENGINES ("gallop", "numpy").
+
+        si self.engine no es "merge", solve_query resolvera las operaciones con las funciones vectorizadas de SAR_posting
+
+        """
+        if(v != "merge" and v not in SAR_posting.ENGINES):
+            raise ValueError(f"Motor desconocido o no disponible: '{v}'")
+        self.engine = v
+
+
 
 
     ###############################
@@ -190,12 +350,14 @@ class SAR_Project:
         self.positional = args['positional']
         self.stemming = args['stem']
         self.permuterm = args['permuterm']
+        self.fuzzy = args.get('fuzzy', False)
+        workers = args.get('workers') or 1
 
-        for dir, subdirs, files in os.walk(root):
-            for filename in files:
-                if filename.endswith('.json'):
-                    fullname = os.path.join(dir, filename)
-                    self.index_file(fullname)
+        # El orden de recorrido se fija ordenando las rutas, de forma
+        # que los docid/newid no dependen del sistema de ficheros ni
+        # del numero de procesos utilizados
+        files = self.list_files(root)
+        self.index_files(files, workers)
 
         ##########################################
         ## COMPLETAR PARA FUNCIONALIDADES EXTRA ##
@@ -203,8 +365,176 @@ class SAR_Project:
 
         self.post_indexing()
 
-    def post_indexing(self):
+
+    def append_dir(self, root, **args):
+        """
+        Indexa solo los ficheros de "root" que no estan ya en el indice, para añadir las noticias
+        nuevas de cada dia sin reconstruirlo. Un fichero ya indexado se reconoce por su ruta, fecha
+        de modificacion y tamaño (self.docs); si ha cambiado se avisa, y hay que reconstruir el indice.
+
+        Se mantiene la configuracion (multifield, stemming...) con la que se creo el indice, y
+        sindex y los permuterm solo se actualizan con los terminos de las noticias nuevas.
+        Un indice abierto con "load" se debe pasar antes a memoria con "materialize".
+
+        param:  "root": directorio raiz de las noticias
+
+        return: lista de ficheros indexados
+
+        """
+        workers = args.get('workers') or 1
+
+        indexed = dict((os.path.abspath(path), (mtime, size)) for path, mtime, size in self.docs.values())
+        files = []
+        for filename in self.list_files(root):
+            stat = indexed.get(os.path.abspath(filename))
+            if(stat is None):
+                files.append(filename)
+            elif(stat != self.file_stat(filename)):
+                print(f"WARNING: '{filename}' ha cambiado desde que se indexo, no se actualiza")
+
+        if(files):
+            start = self.newid
+            self.index_files(files, workers)
+            self.post_indexing(start)
+        return files
+
+
+    def index_files(self, files, workers=1):
+        """
+        Indexa "files", en orden, con "workers" procesos.
+
+        """
+        if(workers > 1 and len(files) > 1):
+            self.index_parallel(files, workers)
+        else:
+            for fullname in files:
+                self.index_file(fullname)
+
+
+    @staticmethod
+    def file_stat(filename):
+        """
+        Fecha de modificacion (en ns) y tamaño de "filename", para saber si ha cambiado.
+
+        """
+        stat = os.stat(filename)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def list_files(self, root):
+        """
+        Devuelve, ordenadas, las rutas de todos los ficheros json (o jsonl) que cuelgan de "root".
+
+        param:  "root": directorio raiz de las noticias
+
+        return: lista ordenada de rutas
+
+        """
+        files = []
+        for dir, subdirs, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.endswith(('.json', '.jsonl')):
+                    files.append(os.path.join(dir, filename))
+        files.sort()
+        return files
+
+
+    def index_parallel(self, files, workers):
+        """
+        Indexa "files" repartiendolos en bloques contiguos entre "workers" procesos.
+
+        Cada proceso construye un indice parcial (index, iindex, weight, freq, news y docs)
+        empezando en docid = newid = 0, y el proceso padre los fusiona en el mismo orden
+        en el que estan los ficheros, por lo que el resultado es identico al de la version secuencial.
+
+        param:  "files": lista ordenada de ficheros a indexar
+                "workers": numero de procesos
+
+        """
+        # Mas bloques que procesos para repartir mejor la carga
+        # cuando los ficheros tienen tamaños muy distintos
+        nchunks = min(len(files), workers * 4)
+        step, extra = divmod(len(files), nchunks)
+        chunks = []
+        start = 0
+        for nchunk in range(nchunks):
+            end = start + step + (nchunk < extra)
+            chunks.append(files[start:end])
+            start = end
+
+        with multiprocessing.Pool(workers) as pool:
+            # imap mantiene el orden de los bloques
+            for shard in pool.imap(_index_shard, chunks):
+                self.merge_shard(shard)
+
+
+    def merge_shard(self, shard):
+        """
+        Añade al indice el indice parcial "shard", desplazando sus docid y newid
+        para que continuen a partir de los ya indexados.
+
+        param:  "shard": SAR_Project con el indice parcial
+
+        """
+        docid_off = self.docid
+        newid_off = self.newid
+
+        for docid, (path, mtime, size) in shard.docs.items():
+            self.docs[docid + docid_off] = (os.path.abspath(path), mtime, size)
+
+        for newid, (docid, date, title, keywords, nt, first_newid) in shard.news.items():
+            self.news[newid + newid_off] = (docid + docid_off, date, title,
+                                            keywords, nt, first_newid + newid_off)
+
+        for newid, data in shard.snippets.items():
+            self.snippets[newid + newid_off] = data
+
+        # ids del vocabulario del shard -> ids del vocabulario global
+        tids = [self.vocab.id(term) for term in shard.vocab.terms]
+        terms = self.vocab.terms
+
+        for field, token_dict in shard.index.items():
+            index = self.index[field]
+            for token, other in token_dict.items():
+                posting = index.get(token)
+                if posting is None:
+                    index[terms[tids[shard.vocab.get(token)]]] = posting = Posting()
+                posting.extend(other, newid_off)
+
+        for field, forward in shard.iindex.items():
+            self.iindex[field].extend(forward, newid_off, tids)
+
+        for token, other_dict in shard.weight.items():
+            weight_dict = self.weight[tids[token]]
+            for other, (before, after) in other_dict.items():
+                pair = weight_dict[tids[other] if other is not None else None]
+                pair[0] += before
+                pair[1] += after
+
+        for token, count in shard.freq.items():
+            self.freq[tids[token]] += count
+
+        self.stem_cache.update(shard.stem_cache)
+
+        self.num_days.update(shard.num_days)
+
+        self.docid += shard.docid
+        self.newid += shard.newid
+
+
+    def post_indexing(self, start=0):
+        """
+        Crea los indices derivados (stemming, permuterm...) despues de indexar.
+
+        param:  "start": primer newid nuevo; si no es 0 solo se añaden a los indices
+                         derivados los terminos de las noticias a partir de "start"
+
+        """
         print("Running post indexing:")
+        self.generation += 1
+        self.make_universe()
+        self.make_norms()
+        terms = self.new_terms(start) if start else None
+
         if(self.multifield):
             print("\tMultifield... ", end='')
             # TODO: Multifield call
@@ -217,12 +547,17 @@ class SAR_Project:
 
         if(self.stemming):
             print("\tStemming... ", end='')
-            self.make_stemming()
+            self.make_stemming(terms, start)
             print("DONE")
 
         if(self.permuterm):
             print("\tPermuterm... ", end='')
-            self.make_permuterm()
+            self.make_permuterm(terms)
+            print("DONE")
+
+        if(self.fuzzy):
+            print("\tFuzzy... ", end='')
+            self.make_kgrams(terms)
             print("DONE")
 
     def index_file(self, filename):
@@ -237,15 +572,16 @@ class SAR_Project:
         En estos casos, se recomienda crear nuevos metodos para hacer mas sencilla la implementacion
 
         input: "filename" es el nombre de un fichero en formato JSON Arrays (https://www.w3schools.com/js/js_json_arrays.asp).
-                Una vez parseado con json.load tendremos una lista de diccionarios, cada diccionario se corresponde a una noticia
+                Una vez parseado con json.load tendremos una lista de diccionarios, cada diccionario se corresponde a una noticia.
+                Tambien se acepta JSON Lines, una noticia por linea. Las noticias se leen de una en una
+                con SAR_reader.read_news, sin cargar el fichero entero en memoria.
 
         """
 
-        with open(filename) as fh:
-            jlist = json.load(fh)
+        jlist = SAR_reader.read_news(filename)
 
         #
-        # "jlist" es una lista con tantos elementos como noticias hay en el fichero,
+        # "jlist" es un generador con tantos elementos como noticias hay en el fichero,
         # cada noticia es un diccionario con los campos:
         #      "title", "date", "keywords", "article", "summary"
         #
@@ -257,59 +593,70 @@ class SAR_Project:
         ### COMPLETAR ###
         #################
         
-        self.docs[self.docid] = filename
+        # ruta absoluta: append_dir reconoce los ficheros ya indexados desde cualquier directorio
+        self.docs[self.docid] = (os.path.abspath(filename),) + self.file_stat(filename)
+        vocab_id = self.vocab.id
+        vocab_ids = self.vocab.ids
+        terms = self.vocab.terms
         for num_not, noticia in enumerate(jlist):
-            doc_tuple = (self.docid, self.newid)
+            newid = self.newid
             for field, tokenize in self.fields:
                
                 if tokenize and field != "date":
                     tokens = self.tokenize(noticia[field])
 
                     is_art = field == "article"
+                    if(is_art):
+                        self.snippets[newid] = SAR_snippet.encode(noticia[field])
+                    index = self.index[field]
 
-                    slast = last = ""
+                    slast = last = None
+                    doc_tids = []
                     for nt, token in enumerate(tokens):
-                        if not self.index[field].get(token, 0):
-                            self.index[field][token] = {} # self.index[field][token] = []
-                            
-                        if not self.index[field][token].get(doc_tuple, 0): # if doc_tuple not in self.index[field][token]:
-                            self.index[field][token][doc_tuple] = [] # self.index[field][token].append(doc_tuple)
-                            # self.iindex[field][doc_tuple][token].append(nt)
-                            self.iindex[field][doc_tuple][token].append(nt)
-                        self.index[field][token][doc_tuple].append(nt)
+                        tid = vocab_ids.get(token)
+                        if tid is None:
+                            tid = vocab_id(token)
+                        posting = index.get(token)
+                        if posting is None:
+                            index[terms[tid]] = posting = Posting()
+                        posting.add(newid, nt)
+                        doc_tids.append(tid)
 
                         # To be optimized
                         if(is_art):
-                            if(last):
-                                self.weight[last][token][1] += 1
+                            if(last is not None):
+                                self.weight[last][tid][1] += 1
 
-                            weight_dict = self.weight[token]# Before, after
+                            weight_dict = self.weight[tid]# Before, after
                                 
                             weight_dict[last][0] += 1
-                            self.freq[token] += 1
-                            last = token
+                            self.freq[tid] += 1
+                            last = tid
 
 
                             if(self.stemmer):
-                                stoken = self.stemmer.stem(token)
+                                stoken = self.stem(token)
                                 if(stoken != token):
-                                    if(slast):
-                                        self.weight[slast][stoken][1] += 1
+                                    stid = vocab_id(stoken)
+                                    if(slast is not None):
+                                        self.weight[slast][stid][1] += 1
 
-                                    weight_dict = self.weight[stoken]# Before, after
+                                    weight_dict = self.weight[stid]# Before, after
                                         
                                     weight_dict[slast][0] += 1
-                                    self.freq[stoken] += 1
-                                    slast = stoken
+                                    self.freq[stid] += 1
+                                    slast = stid
+
+                    self.iindex[field].add(newid, Counter(doc_tids))
                     
                 else:
                     token = noticia[field]
-                    if not self.index[field].get(token, 0):
-                            self.index[field][token] = {} # self.index[field][token] = {}
-                    if not self.index[field][token].get(doc_tuple, 0): # if doc_tuple not in self.index[field][token]:
-                        self.index[field][token][doc_tuple] = [] # self.index[field][token].append(doc_tuple)
-                        self.iindex[field][doc_tuple][token].append(0)
-                    self.index[field][token][doc_tuple].append(nt) # ??
+                    tid = vocab_id(token)
+                    posting = self.index[field].get(token)
+                    if posting is None:
+                        self.index[field][terms[tid]] = posting = Posting()
+                    if posting.add(newid, nt): # ??
+                        self.iindex[field].add(newid, {tid: 1})
                     nt = 1 # ??
 
             self.news[self.newid] = (self.docid, noticia["date"], noticia["title"], noticia["keywords"], nt, self.newid-num_not)
@@ -328,22 +675,53 @@ class SAR_Project:
         Tokeniza la cadena "texto" eliminando simbolos no alfanumericos y dividientola por espacios.
         Puedes utilizar la expresion regular 'self.tokenizer'.
 
+        Los tokens son las secuencias de caracteres alfanumericos, que se buscan en una sola
+        pasada (los mismos que sustituyendo "\W+" por espacios y dividiendo, sin las copias).
+
         params: 'text': texto a tokenizar
 
         return: lista de tokens
 
         """
-        return self.tokenizer.sub(' ', text.lower()).split()
+        return self.tokenizer.findall(text.lower())
+
 
 
+    def make_universe(self):
+        """
+        Crea el bitmap con todas las noticias indexadas (self.universe), usado por reverse_posting.
 
-    def make_stemming(self):
+        """
+        self.universe = SAR_posting.to_bitmap(sorted(self.news.keys()))
+
+
+
+    def new_terms(self, start):
+        """
+        Terminos de cada campo que aparecen en las noticias con newid a partir de "start".
+
+        return: {campo: set de terminos}
+
+        """
+        terms = {}
+        for field, forward in self.iindex.items():
+            tids = set(forward.tids[forward.seek(start):])
+            terms[field] = set(map(self.vocab.term, tids))
+        return terms
+
+
+    def make_stemming(self, terms=None, start=0):
         """
         NECESARIO PARA LA AMPLIACION DE STEMMING.
 
         Crea el indice de stemming (self.sindex) para los terminos de todos los indices.
+        La posting de un stem es la union (SAR_posting.union) de las de todos sus terminos,
+        con sus posiciones, para poder hacer consultas posicionales con stemming.
 
-        self.stemmer.stem(token) devuelve el stem del token
+        self.stem(token) devuelve el stem del token
+
+        param:  "terms": {campo: terminos} a actualizar, si es None todos los del indice
+                "start": con "terms", solo se añaden las noticias con newid a partir de "start"
 
         """
         
@@ -356,18 +734,34 @@ class SAR_Project:
         else:
             index_dict = {"article": self.index["article"]}
 
-        # self.index[field][token].append(doc_tuple)
         for field, doc_dict in index_dict.items():
-            for token, doc_list in doc_dict.items():
-                # 1- Todos los field existen, y están 
-                self.sindex[field][self.stemmer.stem(token)] = doc_list
+            sindex = self.sindex[field]
+            tokens = doc_dict if terms is None else terms[field]
+            # una sola pasada por los terminos agrupados por stem
+            stems = sorted((self.stem(token), token) for token in tokens)
+            for stem, group in groupby(stems, key=itemgetter(0)):
+                postings = [doc_dict[token] for _, token in group]
+                if(terms is None):
+                    sindex[stem] = SAR_posting.union(postings)
+                    continue
+
+                # las noticias nuevas van despues de las que ya tiene el stem
+                new = SAR_posting.union([posting.slice(posting.seek(start)) for posting in postings])
+                posting = sindex.get(stem)
+                if(posting is None):
+                    sindex[stem] = new
+                else:
+                    posting.extend(new)
 
     
-    def make_permuterm(self):
+    def make_permuterm(self, terms=None):
         """
         NECESARIO PARA LA AMPLIACION DE PERMUTERM
 
         Crea el indice permuterm (self.ptindex) para los terminos de todos los indices.
+        Solo guarda las rotaciones de los terminos, las posting lists se unen al buscar.
+
+        param:  "terms": {campo: terminos} a añadir, si es None todos los del indice
 
         """
         
@@ -381,20 +775,66 @@ class SAR_Project:
             fields = ["article"]
 
         for field in fields:
-            for token, doc_dict in self.index[field].items():
-                termino = token + '$'
+            self.ptindex[field].add(self.index[field] if terms is None else terms[field])
+        self.wildcard_cache.clear()
+
+    def make_kgrams(self, terms=None):
+        """
+        Crea el indice de k-gramas (self.kgindex) para las busquedas aproximadas ("termino~k").
 
-                for perm in range(len(termino)+1):
-                    perm_term = termino[perm-1:] + termino[:perm]
+        param:  "terms": {campo: terminos} a añadir, si es None todos los del indice
+
+        """
+        if self.multifield:
+            fields = tuple(map(itemgetter(0), self.fields))
+        else:
+            fields = ["article"]
 
-                    if(not perm_term.endswith("$")):
-                        self.ptindex_strict[field][perm_term[:-2]].update(doc_dict.keys())
+        for field in fields:
+            self.kgindex[field].add(self.index[field] if terms is None else terms[field])
+
+
+    def make_norms(self):
+        """
+        Calcula la normalizacion de cada noticia en cada campo para el ranking (self.norms):
+
+            - "bm25": k1 * (1 - b + b * longitud / longitud media)
+            - "tfidf": norma del vector de pesos (1 + log tf) * idf de la noticia
+
+        Depende de la longitud media y de los idf de toda la coleccion, por lo que se
+        recalcula entera cada vez que se añaden noticias.
+
+        """
+        total = len(self.news)
+        terms = self.vocab.terms
+        k1 = self.BM25_K1
+        b = self.BM25_B
+
+        for field, forward in self.iindex.items():
+            index = self.index[field]
+            tids = forward.tids
+            tfs = forward.tfs
+            starts = [forward.seek(newid) for newid in range(total + 1)]
+
+            # sumas acumuladas de la longitud y del cuadrado de los pesos, cada noticia es una resta
+            lengths = list(accumulate(tfs, initial=0))
+            avgdl = lengths[-1] / total if total else 0
+            self.norms["bm25"][field] = array('f', (k1 * (1 - b + b * (lengths[hi] - lengths[lo]) / avgdl)
+                                                    if avgdl else k1 for lo, hi in zip(starts, starts[1:])))
+
+            # pesos (1 + log tf) * idf con tablas indexadas por tf y por id del termino
+            idf = [0.0] * len(terms)
+            for tid in set(tids):
+                idf[tid] = log(total / len(index[terms[tid]]))
+            log_tf = [0.0] + [1 + log(tf) for tf in range(1, max(tfs, default=0) + 1)]
+            weights = list(map(mul, map(log_tf.__getitem__, tfs), map(idf.__getitem__, tids)))
+            squares = list(accumulate(map(mul, weights, weights), initial=0.0))
+            self.norms["tfidf"][field] = array('f', (sqrt(squares[hi] - squares[lo]) or 1.0
+                                                     for lo, hi in zip(starts, starts[1:])))
+
+            for model in self.min_norms:
+                self.min_norms[model][field] = min(self.norms[model][field], default=1.0)
 
-                    # Añadimos los documentos a los prefijos
-                    # para los cálculos de *
-                    for prefix in range(len(perm_term) - perm_term.find('$')):
-                        self.ptindex[field][perm_term[:-prefix]].update(doc_dict.keys())
-                    # self.ptindex[fi[field]][t] = len(permu) if self.ptindex[fi[field]].get(t) == None else self.ptindex[fi[field]][t] + len(permu)    
 
     def make_distance(self, doc:tuple, doc_tokens:list):
         self.weight[doc] = set(nltk.ngrams(doc_tokens, 2))
@@ -414,7 +854,7 @@ class SAR_Project:
 
         print(
             "========================================\n"
-            f"Number of indexed days: {len(set(date for doc in self.iindex['date'].values() for date in doc.keys()))}\n"
+            f"Number of indexed days: {len(set(self.iindex['date'].tids))}\n"
             "----------------------------------------\n"
             f"Number of indexed news: {len(self.news)}\n"
             "----------------------------------------\n"
@@ -425,12 +865,19 @@ class SAR_Project:
             print(f"\t# of tokens in '{key}': {len(token_dict)}")
         print("----------------------------------------\n"
             "PERMUTERMS:")
-        for key, token_dict in self.ptindex.items():
-            print(f"\t# of permuterms in '{key}': {len(token_dict)}")
+        for key, permuterm in self.ptindex.items():
+            print(f"\t# of permuterms in '{key}': {len(permuterm)}")
+        print("----------------------------------------\n"
+            "K-GRAMS:")
+        for key, kgrams in self.kgindex.items():
+            print(f"\t# of k-grams in '{key}': {len(kgrams)}")
         print("----------------------------------------\n"
             "STEMS:")
         for key, token_dict in self.sindex.items():
             print(f"\t# of stems in '{key}': {len(token_dict)}")
+        stem_cache = self.stem_cache
+        print(f"\tstem cache: {len(stem_cache)} terms, hit rate {stem_cache.hit_rate():.1%}"
+            f" ({stem_cache.hits} of {stem_cache.hits + stem_cache.misses})")
         print("----------------------------------------\n"
             f"Positional queries are{' ' if self.positional else ' NOT '}allowed.\n"
             "========================================")
@@ -455,263 +902,289 @@ class SAR_Project:
                 "prev": incluido por si se quiere hacer una version recursiva. No es necesario utilizarlo.
 
 
-        return: posting list con el resultado de la query
+        return: posting list con el resultado de la query, una copia que se puede modificar
 
         """
 
         if(query is None or len(query) == 0):
-            return []
-        
-        query = query.lower().strip()
-
-        if(query.startswith("AND") or query.startswith("OR")):
-            return []
+            return array('I')
 
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
-        result = []
         self.searched_terms.clear()
 
-        permuterm_regex = re.compile(r"[?*]")
+        # La consulta se convierte en un AST (SAR_query), el planificador
+        # reordena los AND por cardinalidad y se evalua recursivamente
+        try:
+            node = self.parse_query(query)
+        except SAR_query.QuerySyntaxError:
+            # Deberiamos devolver una lista vacía??
+            # O dejar pasar una excepción?
+            return array('I')
 
+        # evaluate devuelve arrays compartidos con el indice y con query_cache, de solo lectura
+        return self.evaluate(SAR_query.plan(node, self.estimate))[:]
 
-        query_not = query_and = query_or = False
 
-        # Usado generadores evitamos el uso de memoria
-        if(self.use_stemming):
-            query_iter = (
-                    (word if word in {"NOT", "AND", "OR"}
-                        else self.stemmer.stem(word)
-                    for word in query.split()))
-        else:
-            query_iter = iter(query.split())
+    def solve_batch(self, queries):
+        """
+        Resuelve una lista de queries de una vez, como la del fichero de la opcion -T.
 
-        # recorrem la query, i evitem que bote la excepció del iterador
-        for query_word in query_iter: 
-            if query_word == "NOT": # si comença amb NOT -> neguem el seguent token
-                query_not = True
-                continue
-            elif query_word == "AND":
-                query_and = True
-                continue
-            elif query_word == "OR":
-                query_or = True
-                continue
+        Se parsean y planifican todas antes de empezar. Durante el lote cada Posting
+        (campo, termino) se lee una sola vez (self.batch_postings), las mascaras de posiciones
+        de las frases se comparten (self.batch_masks), y las subconsultas comunes se resuelven
+        una vez gracias a self.query_cache. Las dos primeras tienen un tamaño maximo
+        (BATCH_MEMORY) y se liberan al acabar el lote.
 
+        param:  "queries": lista de cadenas con las queries
 
-            if query_word.startswith('\"'): # posicional
-                query_word = query_word.lstrip('\"')
-
-                positional = []
-                try:
-                    while not query_word.endswith("\""):
-                        positional.append(query_word)
-                        query_word = next(query_iter)
-                except StopIteration:
-                    # Deberiamos devolver una lista vacía??
-                    # O dejar pasar una excepción?
-                    return []
-
-                positional.append(query_word.rstrip('\"'))
-                nextP = self.get_positionals(positional)
-
-            elif(not self.use_stemming and permuterm_regex.search(query_word)): # permuterm
-                # Aqui ponia "queryPartida[1]". Supongo que
-                # estaba mal, así que lo cambio.
-                nextP = self.get_permuterm(*(query_word.split(':',1)[::-1]))
-
-            else: # Multifield & base
-                # Aqui se contemplan ambos casos, que haya ':',
-                # como que no lo haya. Split devolverá uno o dos
-                # elementos en base a si lo hay, y evitamos código
-                # y recorridos de strings innecesarios 
-                nextP = self.get_posting(*(query_word.split(':',1)[::-1]))
- 
-
-            nextP.sort()
-
-            if(query_not):
-                nextP = self.reverse_posting(nextP)
-                query_not = False
-            
-            if(query_and):
-                result = self.and_posting(result, nextP)
-                query_and = False
-            elif(query_or):
-                result = self.or_posting(result, nextP)
-                query_or = False
-            else:
-                result = nextP
+        return: lista con la posting list del resultado de cada query (copias, como solve_query),
+                en el mismo orden
 
         """
-            i = 0
-            if queryPartida[i] == "AND" or queryPartida[i] == "OR": # comprovem que la cadena no comence per operadors
+        nodes = []
+        for query in queries:
+            try:
+                nodes.append(SAR_query.plan(self.parse_query(query), self.estimate) if query else None)
+            except SAR_query.QuerySyntaxError:
+                nodes.append(None)
+
+        self.batch_postings = SAR_cache.LRUCache(self.BATCH_MEMORY, SAR_cache.sizeof)
+        self.batch_masks = SAR_cache.LRUCache(self.BATCH_MEMORY, SAR_cache.sizeof)
+        results = []
+        try:
+            for node in nodes:
+                # como en solve_query, searched_terms solo tiene los terminos de la ultima query
+                self.searched_terms.clear()
+                results.append(self.evaluate(node)[:] if node is not None else array('I'))
+            return results
+        finally:
+            del self.batch_postings
+            del self.batch_masks
+
+
+    def parse_query(self, query):
+        """
+        Convierte la query en un AST de SAR_query.
+
+        param:  "query": cadena con la query
+
+        return: AST de la query
+
+        """
+        return SAR_query.parse(query, fields=self.index)
+
+
+    def explain(self, query):
+        """
+        Devuelve el plan que utilizaria solve_query para resolver la query,
+        con la cardinalidad estimada de cada paso.
+
+        param:  "query": cadena con la query
+
+        return: cadena con el plan
+
+        """
+        try:
+            node = SAR_query.plan(self.parse_query(query), self.estimate)
+        except SAR_query.QuerySyntaxError as e:
+            return f"Syntax error: {e}"
+        return SAR_query.explain(node, self.estimate)
+
+
+    def estimate(self, node):
+        """
+        Estima el numero de noticias que devuelve un nodo del AST, sin decodificar posting lists.
+
+        param:  "node": nodo del AST
+
+        return: cardinalidad estimada
+
+        """
+        cls = type(node)
+        total = len(self.news)
+
+        if(cls is SAR_query.Term):
+            return self.document_frequency(self.stem_term(node.term), node.field)
+        if(cls is SAR_query.Phrase):
+            return min(self.document_frequency(self.stem_term(term), node.field) for term in node.terms)
+        if(cls is SAR_query.Near):
+            return min(self.document_frequency(self.stem_term(node.left), node.field),
+                        self.document_frequency(self.stem_term(node.right), node.field))
+        if(cls is SAR_query.Not):
+            return total - self.estimate(node.child)
+        if(cls is SAR_query.And):
+            # suponiendo independencia, cada NOT deja la fraccion de noticias que no excluye
+            estimate = min((self.estimate(child) for child in node.children
+                                if type(child) is not SAR_query.Not), default=total)
+            for child in node.children:
+                if(type(child) is SAR_query.Not and total):
+                    estimate = estimate * self.estimate(child) // total
+            return estimate
+        if(cls is SAR_query.Or):
+            return min(total, sum(map(self.estimate, node.children)))
+        if(cls is SAR_query.Wildcard):
+            return min(total, sum(self.document_frequency(term, node.field, stemming=False)
+                                    for term in self.expand_wildcard(node.pattern, node.field)))
+        if(cls is SAR_query.Fuzzy):
+            return min(total, sum(self.document_frequency(term, node.field, stemming=False)
+                                    for term in self.kgindex[node.field].lookup(node.term, node.distance)))
+        return total
+
+
+    def document_frequency(self, term, field='article', stemming=None):
+        """
+        Numero de noticias que contienen "term" en "field".
+
+        param:  "stemming": si se busca en el indice de stems, por defecto self.use_stemming
+
+        """
+        if(stemming is None):
+            stemming = self.use_stemming
+        index = self.sindex[field] if stemming else self.index[field]
+        df = getattr(index, "df", None) # los segmentos lo leen sin decodificar la posting
+        if(df is not None):
+            return df(term)
+        posting = index.get(term)
+        return len(posting) if posting is not None else 0
+
+
+    def max_tf(self, term, field='article', stemming=None):
+        """
+        Maxima frecuencia de "term" en una noticia de "field", para las cotas de rank_top.
+
+        param:  "stemming": si se busca en el indice de stems, por defecto self.use_stemming
+
+        """
+        if(stemming is None):
+            stemming = self.use_stemming
+        index = self.sindex[field] if stemming else self.index[field]
+        max_tf = getattr(index, "max_tf", None) # los segmentos la guardan en el registro del termino
+        if(max_tf is not None):
+            return max_tf(term)
+        posting = index.get(term)
+        if(posting is None):
+            return 0
+        offsets = posting.offsets
+        return max(map(sub, offsets[1:], offsets), default=0)
+
+
+    def stem_term(self, term):
+        """
+        Devuelve el stem de "term" si se esta usando stemming, si no el propio termino.
+
+        """
+        return self.stem(term) if self.use_stemming else term
+
+
+    def stem(self, token):
+        """
+        Devuelve el stem de "token". Los stems se guardan en self.stem_cache, que se
+        llena al indexar y se guarda con el indice, para no repetir self.stemmer.stem.
+
+        """
+        stem = self.stem_cache.get(token)
+        if(stem is None):
+            stem = self.stem_cache[token] = self.stemmer.stem(token)
+        return stem
+
+
+    def evaluate(self, node):
+        """
+        Evalua un nodo del AST ya planificado, con self.query_cache.
+
+        Salvo los terminos (su posting ya esta en el indice), el resultado de cada subconsulta
+        se guarda con la forma normalizada del nodo (SAR_query.normalize), el uso de stemming
+        (los campos estan en el nodo) y la version del indice, asi que se reutiliza entre
+        queries y deja de usarse en cuanto se añaden noticias.
+
+        param:  "node": nodo del AST
+
+        return: posting list con el resultado, de solo lectura (puede ser la del indice o la de la cache)
+
+        """
+        if(type(node) is SAR_query.Term):
+            return self.evaluate_node(node)
+
+        cache = self.query_cache
+        key = (self.generation, self.use_stemming, SAR_query.normalize(node))
+        entry = cache.get(key)
+        if(entry is not None):
+            self.query_time_saved += entry[1]
+            return entry[0]
+
+        start = time.perf_counter()
+        result = self.evaluate_node(node)
+        cache[key] = (result, time.perf_counter() - start)
+        return result
+
+
+    def evaluate_node(self, node):
+        """
+        Evalua un nodo del AST ya planificado, sin mirar la cache.
+
+        Los AND se resuelven en el orden del plan y paran en cuanto el resultado es vacio.
+        Los NOT dentro de un AND se resuelven como diferencias, solo los demas calculan el complemento.
+
+        param:  "node": nodo del AST
+
+        return: posting list con el resultado
+
+        """
+        cls = type(node)
+
+        if(cls is SAR_query.Term):
+            return self.get_term_posting(self.stem_term(node.term), node.field).newids
+
+        if(cls is SAR_query.Wildcard):
+            return self.get_permuterm(node.pattern, node.field)
+
+        if(cls is SAR_query.Fuzzy):
+            return self.get_fuzzy(node.term, node.distance, node.field)
+
+        if(cls is SAR_query.Phrase):
+            return self.get_positionals([self.stem_term(term) for term in node.terms], node.field)
+
+        if(cls is SAR_query.Near):
+            return self.get_near(self.stem_term(node.left), self.stem_term(node.right),
+                                    node.distance, node.ordered, node.field)
+
+        if(cls is SAR_query.Not):
+            return self.reverse_posting(self.evaluate(node.child))
+
+        if(cls is SAR_query.Or):
+            result = array('I')
+            for child in node.children:
+                result = self.or_posting(result, self.evaluate(child))
             return result
-            if len(queryPartida) <3: # per a cadenes amb <3 elements
-            if len(queryPartida) == 2 and queryPartida[i] == "NOT": # si comença amb NOT -> negació
-                if ':' in queryPartida[1]:
-                    mqPartida = queryPartida[1].split(':')
-                    nextP = self.get_posting(mqPartida[1], mqPartida[0])
-                elif "?" in queryPartida[i] or "*" in queryPartida[i]:
-                    nextP = self.get_permuterm(queryPartida[1])
-                else:
-                    nextP = self.get_posting(queryPartida[1])
-                nextP = list(nextP)
-                nextP.sort()
-                return self.reverse_posting(nextP)
-            elif len(queryPartida) <= 2  and queryPartida[i] != "NOT": # si no comença amb NOT -> resolem query del primer elemen només (?)
-                if ':' in queryPartida[i]: # multifield
-                    mqPartida = queryPartida[i].split(':')
-                    nextP = self.get_posting(mqPartida[1], mqPartida[0])
-                elif len(queryPartida) == 2 and queryPartida[i].startswith("\"") and queryPartida[i+1].endswith("\""): # posicionals
-                    nextP = self.get_positionals(queryPartida)
-                elif "?" in queryPartida[i] or "*" in queryPartida[i]: # permuterm
-                    nextP = self.get_permuterm(queryPartida[i])
+
+        # AND: primero los positivos (de menor a mayor), despues las diferencias
+        positives = [child for child in node.children if type(child) is not SAR_query.Not]
+        negatives = [child.child for child in node.children if type(child) is SAR_query.Not]
+
+        if(positives):
+            result = self.evaluate(positives[0])
+            for child in positives[1:]:
+                if(not result):
+                    return result
+                if(type(child) is SAR_query.Term):
+                    # el Posting completo, para poder usar sus skip pointers
+                    other = self.get_term_posting(self.stem_term(child.term), child.field)
                 else:
-                    nextP = self.get_posting(queryPartida[i])
+                    other = self.evaluate(child)
+                result = self.and_posting(result, other)
+        else:
+            # NOT a AND NOT b = NOT (a OR b)
+            return self.reverse_posting(self.evaluate(SAR_query.Or(tuple(negatives))))
 
-                nextP = list(nextP)
-                nextP.sort()
-                return nextP
-            else: # si no es compleixen les condicions -> error de sintaxi
+        for child in negatives:
+            if(not result):
                 return result
-           else: # per a queries >2 elements
-            while i < len(queryPartida) - 1: # recorrem la query
-                if queryPartida[i] == "NOT": # si comença amb NOT -> neguem el seguent token
-                    if ':' in queryPartida[i + 1]:
-                        mqPartida = queryPartida[i + 1].split(':')
-                        nextP = self.get_posting(mqPartida[1], mqPartida[0])
-                    elif queryPartida[i].startswith("\""): # posicional
-                        i = i + 1 # posem i sobre el primer token posicional
-                        positional = []
-                        while not queryPartida[i].endswith("\"") and i < len(queryPartida): # recorrem la query per buscar el final del sintagma posicional
-                            positional.append(queryPartida[i])
-                            i = i + 1
-                        if i < len(queryPartida):
-                            positional.append(queryPartida[i])
-                            nextP = self.get_positionals(positional)
-                        else: 
-                            return []
-                    elif "?" in queryPartida[i] or "*" in queryPartida[i]:
-                        nextP = self.get_permuterm(queryPartida[1])
-                    else:
-                        nextP = self.get_posting(queryPartida[i + 1])
-                    nextP = list(nextP)
-                    nextP.sort()
-                    result = self.reverse_posting(nextP)
-                    i = i + 1
-                else:
-                    if queryPartida[i] == "AND": # si token == AND -> resolem la query seguent i apliquem AND
-                        if queryPartida[i + 1] == "NOT":
-                            if ':' in queryPartida[i + 2]:
-                                mqPartida = queryPartida[i + 2].split(':')
-                                nextP = self.get_posting(mqPartida[1],mqPartida[0])
-                            elif queryPartida[i].startswith("\""):
-                                positional = []
-                                while i < len(queryPartida) and not queryPartida[i].endswith("\""):
-                                    positional.append(queryPartida[i])
-                                    i = i + 1
-                                if i < len(queryPartida):
-                                    positional.append(queryPartida[i])
-                                nextP = self.get_positionals(positional) 
-                            elif "?" in queryPartida[i] or "*" in queryPartida[i]:
-                                nextP = self.get_permuterm(queryPartida[1])
-                            else:
-                                nextP = self.get_posting(queryPartida[i + 2])
-                            nextP = list(nextP)
-                            nextP.sort()
-                            nextP = self.reverse_posting(nextP)
-                            result = self.and_posting(result, nextP)
-                            i = i + 2
-                        else:
-                            if ':' in queryPartida[i + 1]:
-                                mqPartida = queryPartida[i + 1].split(':')
-                                nextP = self.get_posting(mqPartida[1], mqPartida[0])
-                            elif queryPartida[i + 1].startswith("\""):
-                                positional = []
-                                i = i + 1
-                                while i < len(queryPartida) and not queryPartida[i].endswith("\""):
-                                    positional.append(queryPartida[i])
-                                    i = i + 1
-                                if i < len(queryPartida):
-                                    positional.append(queryPartida[i])
-                                print(positional)
-                                nextP = self.get_positionals(positional) 
-                            elif "?" in queryPartida[i] or "*" in queryPartida[i]:
-                                nextP = self.get_permuterm(queryPartida[1])
-                            else:
-                                nextP = self.get_posting(queryPartida[i + 1])
-                            nextP = list(nextP)
-                            nextP.sort()
-                            result = self.and_posting(result, nextP)
-                            i = i + 1
-                    elif queryPartida[i] == "OR": # si token == OR -> resolem la query seguent i apliquem OR
-                        if queryPartida[i + 1] == "NOT":
-                            if ':' in queryPartida[i + 2]:
-                                mqPartida = queryPartida[i + 2].split(':')
-                                nextP = self.get_posting(mqPartida[1], mqPartida[0])
-                            elif queryPartida[i].startswith("\""):
-                                positional = []
-                                while i < len(queryPartida) and not queryPartida[i].endswith("\""):
-                                    positional.append(queryPartida[i])
-                                    i = i + 1
-                                if i < len(queryPartida):
-                                    positional.append(queryPartida[i])
-                                nextP = self.get_positionals(positional) 
-                            elif "?" in queryPartida[i] or "*" in queryPartida[i]:
-                                nextP = self.get_permuterm(queryPartida[1])
-                            else:
-                                nextP = self.get_posting(queryPartida[i + 2])
-                            nextP = list(nextP)
-                            nextP.sort()
-                            nextP = self.reverse_posting(nextP)
-                            result = self.or_posting(result, nextP)
-                            i = i + 2
-                        else:
-                            if ':' in queryPartida[i + 1]:
-                                mqPartida = queryPartida[i + 1].split(':')
-                                nextP = self.get_posting(mqPartida[1], mqPartida[0])
-                            elif queryPartida[i].startswith("\""):
-                                positional = []
-                                while i < len(queryPartida) and not queryPartida[i].endswith("\""):
-                                    positional.append(queryPartida[i])
-                                    i = i + 1
-                                if i < len(queryPartida):
-                                    positional.append(queryPartida[i])
-                                nextP = self.get_positionals(positional) 
-                            elif "?" in queryPartida[i] or "*" in queryPartida[i]:
-                                nextP = self.get_permuterm(queryPartida[1])
-                            else:
-                                nextP = self.get_posting(queryPartida[i + 1])
-                            nextP = list(nextP)
-                            nextP.sort()
-                            result = self.or_posting(result, nextP)
-                            i = i + 1
-                    else: # per qualsevol altre cas -> resolem la query normalment (primer token)
-                        if ':' in queryPartida[i]:
-                            mqPartida = queryPartida[i].split(':')
-                            result = self.get_posting(mqPartida[1], mqPartida[0])
-                        elif queryPartida[i].startswith("\""):
-                            positional = []
-                            while i < len(queryPartida) and not queryPartida[i].endswith("\""):
-                                positional.append(queryPartida[i])
-                                i = i + 1
-                            if i < len(queryPartida):
-                                positional.append(queryPartida[i])
-                            result = self.get_positionals(positional) 
-                        elif "?" in queryPartida[i] or "*" in queryPartida[i]:
-                            nextP = self.get_permuterm(queryPartida[1])
-                        else:
-                            result = self.get_posting(queryPartida[i])
-                        result = list(result)
-                        result.sort()
-                i = i + 1
-        """
-        # print(result)
+            result = self.minus_posting(result, self.evaluate(child))
+
         return result
 
- 
 
 
     def get_posting(self, term, field='article'):
@@ -728,7 +1201,7 @@ class SAR_Project:
         param:  "term": termino del que se debe recuperar la posting list.
                 "field": campo sobre el que se debe recuperar la posting list, solo necesario se se hace la ampliacion de multiples indices
 
-        return: posting list
+        return: posting list, una copia que se puede modificar
 
         """
        
@@ -736,11 +1209,50 @@ class SAR_Project:
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
+        return self.get_term_posting(term, field).newids[:]
+
+
+    def get_term_posting(self, term, field='article'):
+        """
+        Devuelve el Posting completo (newids, posiciones y skip pointers) de un termino,
+        o un Posting vacio si no esta indexado.
+
+        param:  "term": termino (ya con stemming si se usa)
+                "field": campo del indice
+
+        return: Posting
+
+        """
         self.searched_terms.append(field + ":" + term)
+        postings = self.batch_postings
+        if(postings is not None):
+            posting = postings.get((field, term))
+            if(posting is not None):
+                return posting
+
         if(self.use_stemming):
-            return list(self.sindex[field].get(term, {}).keys())
+            posting = self.sindex[field].get(term)
         else:
-            return list(self.index[field].get(term, {}).keys())
+            posting = self.index[field].get(term)
+        if(posting is None):
+            posting = Posting()
+        if(postings is not None):
+            postings[field, term] = posting
+        return posting
+
+
+    def get_position_masks(self, term, field='article'):
+        """
+        Mascaras de posiciones (SAR_posting.position_masks) de un termino, que se calculan una
+        vez por lote de solve_batch y se comparten entre todas sus frases.
+
+        return: {newid: mascara}
+
+        """
+        masks = self.batch_masks.get((field, term))
+        if(masks is None):
+            masks = self.batch_masks[field, term] = SAR_posting.position_masks(self.get_term_posting(term, field))
+        return masks
 
 
 
@@ -756,48 +1268,87 @@ class SAR_Project:
         return: posting list
 
         """
-        self.searched_terms.append(field + ":" + terms[0])
-        if terms[0].startswith("\""):
-            terms[0] = terms[0][1:]
-            terms[-1] = terms[-1][:-1]
-
-        # print(terms[0])
-        if(self.use_stemming):
-            aux = self.sindex[field][terms[0]]
-        else:
-            aux = self.index[field][terms[0]]
-        # print(aux)
-        result = []
-        vists = []
-        coincidencia = False
-        
         ########################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE POSICIONALES ##
         ########################################################
 
-        # FUNCIONA PER A TOT SINTAGMA DE TERMES CONSECUTIUS, PERÒ NO ÉS CAPAÇ DE DETECTAR INSTÀNCIES ON UN DELS TERMES INTERMIJOS FALLA!!!
+        if(len(terms) > 1 and self.batch_masks is not None):
+            # En un lote, con las mascaras de posiciones compartidas entre todas sus frases
+            return SAR_posting.mask_phrase([self.get_position_masks(term, field) for term in terms])
+
+        # Un Posting por termino distinto: los terminos repetidos
+        # comparten posting pero cada aparicion tiene su desplazamiento
+        postings = {}
+        for term in terms:
+            if(term not in postings):
+                postings[term] = self.get_term_posting(term, field)
+
+        # Candidatas: noticias con todos los terminos, intersectando
+        # desde la posting mas corta (con skip pointers)
+        ordered = sorted(postings.values(), key=len)
+        candidates = ordered[0].newids
+        for posting in ordered[1:]:
+            if(not candidates):
+                return array('I')
+            candidates = self.and_posting(candidates, posting)
+
+        if(len(terms) == 1):
+            return candidates
+
+        # Para cada candidata, merge de las listas ordenadas de posiciones
+        distinct = list(postings)
+        offsets = [distinct.index(term) for term in terms]
+        cursors = [0] * len(distinct)
+        result = array('I')
+        for newid in candidates:
+            positions = []
+            for nterm, term in enumerate(distinct):
+                posting = postings[term]
+                cursors[nterm] = j = posting.seek(newid, cursors[nterm])
+                positions.append(posting.positions_at(j))
+
+            if(SAR_posting.phrase_match([positions[nterm] for nterm in offsets])):
+                result.append(newid)
+
+        return result
 
-        if len(terms) == 1:
-            for _, (key, key2) in enumerate(aux):
-                result.append((key, key2)) 
-            return result
 
-        for term in terms[1:]:
-            self.searched_terms.append(field + ":" + term)
-            for _, (key, key2) in enumerate(aux): # recorrem el diccionari aux
-                if (key, key2) in vists: continue # si ja hem visitat un document i no pot haver instàncies de la query, passem al seguent document
-                p1 = aux.get((key, key2))
-                if self.index[field][term].get((key, key2), 0): # comprovem si la clau (docid, newid) existeix per al terme actual
-                    p2 = self.index[field][term].get((key, key2))
-                    for pos in p1:
-                        if int(pos + terms.index(term)) in p2: # comprovem que p2 continga posicions contigues i afegim la clau al resultat
-                            if (key, key2) not in result: result.append((key, key2))
-                            coincidencia = True
-                if not coincidencia: 
-                    vists.append((key,key2))
-                    if (key, key2) in result: result.remove((key, key2))
-                coincidencia = False
+    def get_near(self, left, right, distance, ordered=False, field='article'):
+        """
+        Devuelve la posting list de las noticias donde "left" y "right" aparecen
+        a "distance" posiciones o menos (consultas "left NEAR/k right" y "left ONEAR/k right").
+
+        param:  "left", "right": terminos (ya con stemming si se usa)
+                "distance": distancia maxima entre las dos apariciones
+                "ordered": si "right" debe aparecer despues de "left"
+                "field": campo sobre el que se debe recuperar la posting list
 
+        return: posting list
+
+        """
+        if(self.batch_masks is not None):
+            # el mismo objeto si es el mismo termino, mask_near lo distingue asi
+            left_masks = self.get_position_masks(left, field)
+            right_masks = left_masks if left == right else self.get_position_masks(right, field)
+            return SAR_posting.mask_near(left_masks, right_masks, distance, ordered)
+
+        left_posting = self.get_term_posting(left, field)
+        right_posting = self.get_term_posting(right, field)
+
+        # Candidatas: las noticias con los dos terminos
+        if(len(left_posting) <= len(right_posting)):
+            candidates = self.and_posting(left_posting.newids, right_posting)
+        else:
+            candidates = self.and_posting(right_posting.newids, left_posting)
+
+        result = array('I')
+        i = j = 0
+        for newid in candidates:
+            i = left_posting.seek(newid, i)
+            j = right_posting.seek(newid, j)
+            if(SAR_posting.near_match(left_posting.positions_at(i), right_posting.positions_at(j),
+                                        distance, ordered)):
+                result.append(newid)
         return result
 
 
@@ -817,7 +1368,8 @@ class SAR_Project:
         ####################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE STEMMING ##
         ####################################################
-        return self.sindex[field].get(self.stemmer.stem(term), [])
+        posting = self.sindex[field].get(self.stem(term))
+        return posting.newids if posting is not None else array('I')
 
 
     def get_permuterm(self, term, field='article'):
@@ -826,7 +1378,7 @@ class SAR_Project:
 
         Devuelve la posting list asociada a un termino utilizando el indice permuterm.
 
-        param:  "term": termino para recuperar la posting list, "term" incluye un comodin (* o ?).
+        param:  "term": termino para recuperar la posting list, "term" incluye uno o varios comodines (* o ?).
                 "field": campo sobre el que se debe recuperar la posting list, solo necesario se se hace la ampliacion de multiples indices
 
         return: posting list
@@ -837,29 +1389,48 @@ class SAR_Project:
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA PERMUTERM ##
         ##################################################
 
-        ast_pos = term.find('*')
-        if(ast_pos != -1):
-            return list(self.ptindex[field].get(
-                    term[ast_pos+1:] + '$' + term[:ast_pos]
-                    , []))
+        index = self.index[field]
+        newids = set()
+        for token in self.expand_wildcard(term, field):
+            newids.update(index[token].newids)
+        return array('I', sorted(newids))
+
+
+    def get_fuzzy(self, term, distance=1, field='article'):
+        """
+        Devuelve la posting list de los terminos a "distance" ediciones o menos de "term"
+        (consulta "term~distance"), usando el indice de k-gramas.
 
-        quest_pos = term.find('?')
-        if(quest_pos != -1):
-            return list(self.ptindex_strict[field].get(
-                    term[quest_pos+1:] + '$' + term[:quest_pos]
-                    , []))
+        param:  "term": termino buscado, sin stemming
+                "distance": distancia de edicion maxima
+                "field": campo sobre el que se debe recuperar la posting list
 
-        return []
+        return: posting list
 
         """
-        for permuterms in self.ptindex[field]: # ptindex[field][term]
-            for term in permuterms:
-                if term.startswith(query):
-                    print("Permuterm encontrado")
-                    return self.index[field][term]
+        index = self.index[field]
+        newids = set()
+        for token in self.kgindex[field].lookup(term, distance):
+            newids.update(index[token].newids)
+        return array('I', sorted(newids))
+
+
+    def expand_wildcard(self, pattern, field='article'):
         """
+        Devuelve los terminos de "field" que encajan con "pattern" (con * y ? en cualquier
+        posicion), usando el indice permuterm. Las expansiones se guardan en self.wildcard_cache.
+
+        param:  "pattern": termino con comodines
+                "field": campo de los terminos
 
+        return: tupla de terminos
 
+        """
+        key = (field, pattern)
+        terms = self.wildcard_cache.get(key)
+        if(terms is None):
+            terms = self.wildcard_cache[key] = tuple(self.ptindex[field].lookup(pattern))
+        return terms
 
 
     def reverse_posting(self, p):
@@ -882,29 +1453,13 @@ class SAR_Project:
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
         
-        noticias = []
-        newid = list(self.news.keys())
-        newid.sort()
-        for new in newid:
-            noticias.append((self.news[new][0], new))
-        result = []
-        i = 0
-        j = 0
-        while (i < len(p)) & (j < len(noticias)):
-            if p[i] == noticias[j]:
-                i = i + 1
-                j = j + 1
-            elif p[i] < noticias[j]:
-                i = i + 1
-            else:
-                result.append(noticias[j])
-                j = j + 1
-        
-        while j < len(noticias):
-            result.append(noticias[j])
-            j = j + 1
+        # Complemento sobre el bitmap de todas las noticias, creado una
+        # sola vez al indexar. Para "x AND NOT y" solve_query utiliza
+        # minus_posting y ni siquiera se llega a calcular el complemento
+        if(self.universe is None):
+            self.make_universe()
 
-        return result
+        return SAR_posting.from_bitmap(self.universe & ~SAR_posting.to_bitmap(p))
 
 
 
@@ -914,7 +1469,7 @@ class SAR_Project:
 
         Calcula el AND de dos posting list de forma EFICIENTE
 
-        param:  "p1", "p2": posting lists sobre las que calcular
+        param:  "p1", "p2": posting lists sobre las que calcular, "p2" puede ser un Posting con skip pointers
 
 
         return: posting list con los newid incluidos en p1 y p2
@@ -926,7 +1481,17 @@ class SAR_Project:
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
         
-        result = []
+        if(isinstance(p2, Posting)):
+            # Si p1 es mucho mas corta, los skip pointers de p2 permiten
+            # saltar bloques enteros en vez de recorrerla elemento a elemento
+            if(len(p1) * self.SKIP_RATIO < len(p2)):
+                return SAR_posting.skip_and(p1, p2)
+            p2 = p2.newids
+
+        if(self.engine != "merge"):
+            return SAR_posting.ENGINES[self.engine][0](p1, p2)
+
+        result = array('I')
         i = 0
         j = 0
         while (i < len(p1)) & (j < len(p2)):
@@ -962,7 +1527,10 @@ class SAR_Project:
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
         
-        result = []
+        if(self.engine != "merge"):
+            return SAR_posting.ENGINES[self.engine][1](p1, p2)
+
+        result = array('I')
         i = 0
         j = 0
         while (i < len(p1)) & (j < len(p2)):
@@ -999,7 +1567,10 @@ class SAR_Project:
         ########################################################
         ## COMPLETAR PARA TODAS LAS VERSIONES SI ES NECESARIO ##
         ########################################################
-        result = []
+        if(self.engine != "merge"):
+            return SAR_posting.ENGINES[self.engine][2](p1, p2)
+
+        result = array('I')
         i = 0
         j = 0
         while (i < len(p1)) & (j < len(p2)):
@@ -1037,12 +1608,6 @@ class SAR_Project:
         return: el numero de noticias recuperadas, para la opcion -T
 
         """
-        if(self.use_stemming):
-            query = ' '.join(
-                    (word if word in {"NOT", "AND", "OR"}
-                        else self.stemmer.stem(word)
-                    for word in query.split()))
-
         result = self.solve_query(query)
         
         print("%s\t%d" % (query, len(result)))
@@ -1067,32 +1632,25 @@ class SAR_Project:
 
         print(f"Query: '{query}'")
 
-        if(self.use_stemming):
-            query = ' '.join(
-                    (word if word in {"NOT", "AND", "OR"}
-                        else self.stemmer.stem(word)
-                    for word in query.split()))
-
         result = self.solve_query(query)
 
         print(f"Number of results: {len(result)}")
+        total = len(result)
 
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
-        query_words = set(filter(None, map(
-            lambda word: word.split(':',1)[-1],
-            re.sub("(NOT\s+\S+)|(AND)|(OR)", '', query.lower()).split())))
-
-        if(self.use_stemming):
-            query_words = set(self.stemmer.stem(word) for word in query_words)
+        try:
+            query_terms = SAR_query.positive_terms(self.parse_query(query))
+        except SAR_query.QuerySyntaxError:
+            query_terms = []
+        query_words = set(self.stem_term(term) for _, term in query_terms)
 
 
         if self.use_ranking:
-            result = self.rank_result(result, query_words)   
-
-        clean_regex = re.compile("[\W\n\t]+")
+            # sin -A solo se muestran los SHOW_MAX primeros, no hace falta puntuar el resto
+            result = self.rank_result(result, query_terms, None if self.show_all else self.SHOW_MAX)
 
         # Debido a la posible gran cantidad de documentos,
         # Hago una lista con los string de los print para
@@ -1100,66 +1658,75 @@ class SAR_Project:
         # el código.
         found_match = []
         if self.show_snippet:
-            last_doc_id = -1
-            for solved in (result if self.show_all else result[:10]):
-                doc_id, news_num = solved[:2]
-                
-                # self.news[self.newid] = (self.docid, noticia["date"], noticia["title"], noticia["keywords"], nt)
-                _, date, title, keywords, _, news_in_doc_num = self.news[news_num]
+            if not self.use_ranking:
+                result = [(news_num, 0) for news_num in
+                            (result if self.show_all else result[:self.SHOW_MAX])]
 
-                if(doc_id != last_doc_id):
-                    last_doc_id = doc_id
-                    with open(self.docs[doc_id], 'r') as file:
-                        # Only get news for memory usage
-                        docs = tuple(map(lambda news: news["article"], json.load(file)))
+            # las posiciones de los terminos en el articulo (self.snippets) salen de sus postings
+            index = (self.sindex if self.use_stemming else self.index)["article"]
+            postings = [posting for posting in map(index.get, query_words) if posting is not None]
+            transform = self.stem if self.use_stemming else None
 
-                article = clean_regex.sub(' ', docs[news_num-news_in_doc_num].lower()).split()
+            for news_num, score in (result if self.show_all else result[:self.SHOW_MAX]):
+                # self.news[self.newid] = (self.docid, noticia["date"], noticia["title"], noticia["keywords"], nt)
+                doc_id, date, title, keywords, _, _ = self.news[news_num]
 
-                if(self.use_stemming):
-                    article = tuple(map(self.stemmer.stem, article))
+                article = SAR_snippet.decode(self.snippets[news_num], self.tokenizer)
+                positions = set()
+                for posting in postings:
+                    i = posting.find(news_num)
+                    if(i != -1):
+                        positions.update(posting.positions_at(i))
+                positions = sorted(positions)
 
                 found_match.append(f"#{doc_id}\n"
-                    f"Score: { 0 if self.use_ranking else solved[2]}\n"
+                    f"Score: {score}\n"
                     f"{doc_id}\n"
                     f"Date: {date}\n"
                     f"Title: {title}\n"
                     f"Keywords: {keywords}\n"
                 )
-
-                last_pos = 0
-                words_printed = 5
-                for pos, word in enumerate(article):
-                    if(word in query_words):
-                        if(last_pos and pos > last_pos+words_printed):
-                            found_match.append(" ... ")
-                        else:
-                            found_match.append(' ')
-                        
-                        found_match.append(' '.join(
-                                article[max(last_pos, pos-words_printed) : pos+words_printed]
-                            ))
-                        last_pos = pos
-                if(not last_pos):
-                    found_match.append("No se han encontrado snippets en el cuerpo de la notícia ")
+                found_match.extend(SAR_snippet.build(article, positions, transform=transform))
                 found_match.append("\n--------------------\n\n")
 
         print(''.join(found_match))
 
-        return len(result)
+        return total
 
 
 
-    def rank_result(self, result, query):
+    def show_cache_stats(self):
+        """
+        Muestra el uso de las caches creadas desde que se cargo el indice.
+
+        """
+        lines = ["========================================\nCACHES:"]
+        for name in self.CACHES:
+            cache = self.__dict__.get(name)
+            if(cache is None):
+                continue
+            size = f"{cache.size / (1 << 20):.1f} MB, " if cache.weight is not None else ""
+            lines.append(f"\t{name}: {len(cache)} entries, {size}hit rate {cache.hit_rate():.1%}"
+                f" ({cache.hits} of {cache.hits + cache.misses})")
+            if(name == "query_cache"):
+                lines.append(f"\t\ttime saved: {self.query_time_saved * 1000:.1f} ms")
+        lines.append("========================================")
+        print('\n'.join(lines))
+
+
+
+    def rank_result(self, result, query, k=None):
         """
         NECESARIO PARA LA AMPLIACION DE RANKING
 
         Ordena los resultados de una query.
 
         param:  "result": lista de resultados sin ordenar
-                "query": query, puede ser la query original, la query procesada o una lista de terminos
+                "query": lista de terminos, o de (campo, termino), sin stemming
+                "k": si no es None, solo se devuelven los k mejores (con rank_top)
 
 
-        return: la lista de resultados ordenada
+        return: la lista de (newid, score) ordenada por score
 
         """
         
@@ -1167,34 +1734,200 @@ class SAR_Project:
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE RANKING ##
         ###################################################
 
+        terms = [("article", term) if isinstance(term, str) else term for term in query]
+        if(self.ranking == "weight"):
+            ranked = self.rank_weight(result, set(self.stem_term(term) for _, term in terms))
+            return ranked if k is None else ranked[:k]
+        if(k is not None):
+            return self.rank_top(result, terms, k)
+
+        scores = dict.fromkeys(result, 0.0)
+        total = len(self.news)
+        norms = self.norms[self.ranking]
+        k1 = self.BM25_K1 + 1
+
+        # termino a termino: solo se recorren las postings de los terminos de la consulta
+        for field, term in dict.fromkeys(terms): # sin repetir, en un orden fijo
+            term = self.stem_term(term)
+            posting = (self.sindex if self.use_stemming else self.index)[field].get(term)
+            if(posting is None):
+                continue
+            df = len(posting)
+            field_norms = norms[field]
+            if(self.ranking == "bm25"):
+                idf = log(1 + (total - df + 0.5) / (df + 0.5))
+                for newid, tf in self.posting_tfs(posting, scores):
+                    scores[newid] += idf * tf * k1 / (tf + field_norms[newid])
+            else:
+                idf = log(total / df)
+                for newid, tf in self.posting_tfs(posting, scores):
+                    scores[newid] += (1 + log(tf)) * idf / field_norms[newid]
+
+        return sorted(scores.items(), key=itemgetter(1), reverse=True)
+
+
+    def rank_top(self, result, terms, k):
+        """
+        Los "k" mejores resultados con el mismo modelo que rank_result, sin puntuarlos todos (MaxScore).
+
+        Cada termino tiene una cota de lo que puede aportar a una noticia: su idf por la puntuacion
+        de su maxima frecuencia (self.max_tf) en la noticia con menor normalizacion del campo
+        (self.min_norms); la puntuacion crece con tf y decrece con la normalizacion. Los
+        terminos se procesan de mayor a menor cota, acumulando puntuaciones como en
+        rank_result. En cuanto la k-esima mejor puntuacion supera la suma de las cotas de los
+        terminos que faltan, ninguna noticia nueva puede entrar en el top-k: los terminos restantes
+        solo se buscan (con los skip pointers) en las noticias que aun pueden entrar, en lugar de
+        recorrer sus postings enteras, que suelen ser las mas largas.
+
+        param:  "result": lista ordenada de newids
+                "terms": lista de (campo, termino), sin stemming
+                "k": numero de resultados
+
+        return: la lista de los k mejores (newid, score) ordenada por score
+
+        """
+        total = len(self.news)
+        index = self.sindex if self.use_stemming else self.index
+        norms = self.norms[self.ranking]
+        min_norms = self.min_norms[self.ranking]
+        bm25 = self.ranking == "bm25"
+        k1 = self.BM25_K1 + 1
+
+        # (cota, campo, idf, posting)
+        postings = []
+        for field, term in dict.fromkeys(terms):
+            term = self.stem_term(term)
+            posting = index[field].get(term)
+            if(posting is None):
+                continue
+            df = len(posting)
+            idf = log(1 + (total - df + 0.5) / (df + 0.5)) if bm25 else log(total / df)
+            max_tf = self.max_tf(term, field)
+            if(bm25):
+                upper = idf * max_tf * k1 / (max_tf + min_norms[field])
+            else:
+                upper = idf * (1 + log(max_tf)) / min_norms[field]
+            # las normalizaciones se guardan en float32: un margen para que la cota no quede por debajo
+            upper *= 1 + 1e-6
+            postings.append((upper, field, idf, posting))
+        postings.sort(key=itemgetter(0), reverse=True)
+
+        candidates = dict.fromkeys(result, 0.0) # noticias que pueden entrar en el top-k
+        scores = {}
+        remaining = sum(map(itemgetter(0), postings))
+        pruned = False
+        for nterm, (upper, field, idf, posting) in enumerate(postings, 1):
+            remaining -= upper
+            field_norms = norms[field]
+            for newid, tf in self.posting_tfs(posting, candidates):
+                if(bm25):
+                    score = idf * tf * k1 / (tf + field_norms[newid])
+                else:
+                    score = (1 + log(tf)) * idf / field_norms[newid]
+                scores[newid] = scores.get(newid, 0.0) + score
+
+            if(len(scores) < k or nterm == len(postings)):
+                continue
+            threshold = nlargest(k, scores.values())[-1]
+            if(not pruned and remaining < threshold):
+                # las noticias sin puntuar ya no pueden llegar a la k-esima
+                pruned = True
+            if(pruned):
+                candidates = dict((newid, None) for newid in sorted(scores)
+                                    if scores[newid] + remaining >= threshold)
+
+        top = nlargest(k, scores.items(), key=lambda item: (item[1], -item[0]))
+        # si no hay k noticias con algun termino, se completa con las de puntuacion 0
+        if(len(top) < k):
+            top.extend(islice(((newid, 0.0) for newid in result if newid not in scores), k - len(top)))
+            top.sort(key=lambda item: (-item[1], item[0]))
+        return top
+
+
+    def posting_tfs(self, posting, result):
+        """
+        Frecuencia del termino de "posting" en las noticias de "result" que lo contienen.
+
+        param:  "posting": Posting del termino
+                "result": diccionario con los newid como claves, en orden creciente
+
+        Si "result" es mucho mas corto que la posting se buscan sus newid con los skip pointers,
+        si no se recorre la posting entera.
+
+        return: generador de (newid, tf)
+
+        """
+        newids = posting.newids
+        offsets = posting.offsets
+        if(len(result) * self.SKIP_RATIO < len(newids)):
+            i = 0
+            for newid in result:
+                i = posting.seek(newid, i)
+                if(i == len(newids)):
+                    return
+                if(newids[i] == newid):
+                    yield newid, offsets[i + 1] - offsets[i]
+        else:
+            for i, newid in enumerate(newids):
+                if(newid in result):
+                    yield newid, offsets[i + 1] - offsets[i]
+
+
+    def rank_weight(self, result, query):
+        """
+        Ranking "weight": puntua cada noticia con los pesos de self.weight entre los terminos
+        de la consulta y los de la noticia.
+
+        param:  "result": lista de resultados sin ordenar
+                "query": terminos de la consulta (con stemming si se usa)
+
+        return: la lista de (newid, score) ordenada por score
+
+        """
         scored_result = []
 
         weight_dict = self.weight
-        query = set(q for q in query if q in weight_dict)
+        vocab = self.vocab
+        query = set(tid for tid in map(vocab.get, query) if tid in weight_dict)
 
         for doc in result:
-            tokens = self.iindex["article"][doc]
+            tokens = self.iindex["article"].terms(doc)
             good_score = 0
             good_tokens = 0
 
-            doc_toks = (tokens.keys() if not self.use_stemming else
-                            (map(self.stemmer.stem, tokens.keys())))
+            doc_toks = (tokens if not self.use_stemming else
+                            (vocab.get(self.stem(vocab.term(tid))) for tid in tokens))
 
             for tok in doc_toks:
+                if(tok is None):
+                    continue
                 for good in query:
                     if(tok in weight_dict[good]):
                         good_score += sum(weight_dict[good][tok]) / self.freq[tok]
                         good_tokens += 1
                 
-            scored_result.append((*doc, good_tokens*good_score))
+            scored_result.append((doc, good_tokens*good_score))
 
-        return sorted(scored_result, key=itemgetter(2), reverse=True)
+        return sorted(scored_result, key=itemgetter(1), reverse=True)
 
                 
 
                 
 
 
+def _index_shard(files):
+    """
+    Funcion ejecutada por cada proceso de SAR_Project.index_parallel.
+
+    Indexa "files" en un SAR_Project nuevo y lo devuelve para que el proceso padre lo fusione.
+
+    """
+    shard = SAR_Project()
+    for filename in files:
+        shard.index_file(filename)
+    return shard
+
+
 if __name__ == "__main__":
     s = SAR_Project()
     s.index_file("./2016/01/2016-01-01.json")
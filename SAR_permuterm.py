@@ -0,0 +1,170 @@
+"""
+Indice permuterm compacto de SAR_Project.
+
+En lugar de un diccionario con todos los prefijos de todas las rotaciones de cada termino,
+se guarda una sola lista ordenada de rotaciones, cada una como (id de termino, desplazamiento):
+
+    termino "casa", rotaciones de "casa$":  casa$  asa$c  sa$ca  a$cas  $casa
+
+Un comodin "P*S" se busca como el rango de rotaciones que empiezan por "S$P",
+con dos busquedas binarias. Las rotaciones no se guardan como cadenas, se construyen
+al compararlas. Con varios comodines ("c?sa*", "*ción*") se busca el rango del trozo
+fijo mas largo y los terminos encontrados se filtran con una expresion regular.
+
+"""
+
+import re
+from array import array
+from heapq import merge
+
+
+_WILDCARDS = re.compile(r"[*?]")
+
+
+class Permuterm:
+    """
+    Indice permuterm de los terminos de un campo.
+
+        - terms: lista de terminos, el id de un termino es su posicion
+        - rot_terms, rot_offs: id del termino y desplazamiento de cada rotacion,
+                               ordenadas por la rotacion
+
+    """
+
+    def __init__(self, terms=()):
+        self.terms = []
+        self.rot_terms = array('I')
+        self.rot_offs = array('I')
+        self.add(terms)
+
+
+    def __len__(self):
+        return len(self.rot_terms)
+
+
+    def __contains__(self, term):
+        # la rotacion "$termino" solo la tiene "termino"
+        key = "$" + term
+        i = self._bound(key)
+        return i < len(self) and self.rotation(i) == key
+
+
+    def rotation(self, i):
+        """
+        Devuelve la i-esima rotacion.
+
+        """
+        term = self.terms[self.rot_terms[i]]
+        off = self.rot_offs[i]
+        return term[off:] + "$" + term[:off]
+
+
+    def add(self, terms):
+        """
+        Añade al indice los terminos de "terms" que no esten ya.
+
+        Las rotaciones nuevas se ordenan aparte. Si son pocas, cada una se coloca con una busqueda
+        binaria en las existentes, que se copian a trozos sin construir sus cadenas: añadir pocos
+        terminos a un indice grande no recorre todas sus rotaciones. Si son muchas, se mezclan
+        con las existentes.
+
+        """
+        first = len(self.terms)
+        self.terms.extend(sorted(set(term for term in terms if term not in self)))
+        if(len(self.terms) == first):
+            return
+
+        key = lambda rot: self._rotation(*rot)
+        new = sorted(((tid, off) for tid in range(first, len(self.terms))
+                        for off in range(len(self.terms[tid]) + 1)), key=key)
+
+        rot_terms = array('I')
+        rot_offs = array('I')
+        if(len(new) * len(self).bit_length() < len(self)):
+            start = 0
+            for tid, off in new:
+                # ninguna rotacion nueva es igual a una existente: son de terminos distintos
+                i = self._bound(self._rotation(tid, off), lo=start)
+                rot_terms.extend(self.rot_terms[start:i])
+                rot_offs.extend(self.rot_offs[start:i])
+                rot_terms.append(tid)
+                rot_offs.append(off)
+                start = i
+            rot_terms.extend(self.rot_terms[start:])
+            rot_offs.extend(self.rot_offs[start:])
+        else:
+            for tid, off in merge(zip(self.rot_terms, self.rot_offs), new, key=key):
+                rot_terms.append(tid)
+                rot_offs.append(off)
+        self.rot_terms = rot_terms
+        self.rot_offs = rot_offs
+
+
+    def _rotation(self, tid, off):
+        term = self.terms[tid]
+        return term[off:] + "$" + term[:off]
+
+
+    def _bound(self, key, upper=False, lo=0):
+        """
+        Primera rotacion mayor o igual que "key" o, si "upper", primera
+        rotacion que no empieza por "key" y es mayor que ella. Solo se
+        buscan las rotaciones a partir de la "lo"-esima.
+
+        """
+        hi = len(self)
+        size = len(key)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            rotation = self.rotation(mid)
+            if(upper):
+                rotation = rotation[:size]
+            if(rotation < key or (upper and rotation == key)):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+    def prefix_range(self, key):
+        """
+        Rango [inicio, fin) de las rotaciones que empiezan por "key".
+
+        """
+        return self._bound(key), self._bound(key, upper=True)
+
+
+    def lookup(self, pattern):
+        """
+        Terminos que encajan con "pattern", con cualquier numero de comodines:
+        * (cero o mas caracteres) y ? (exactamente un caracter).
+
+        El rango de rotaciones se busca con el trozo sin comodines mas selectivo: el
+        principio y el final del patron juntos ("S$P") o, si es mas largo, uno intermedio.
+
+        param:  "pattern": termino con comodines
+
+        return: lista de terminos
+
+        """
+        pieces = _WILDCARDS.split(pattern)
+        if(len(pieces) == 1):
+            return []
+
+        prefix, suffix = pieces[0], pieces[-1]
+        key = suffix + "$" + prefix
+        middle = max(pieces[1:-1], key=len, default="")
+        if(len(middle) > len(prefix) + len(suffix)):
+            key = middle
+
+        start, end = self.prefix_range(key)
+        tids = sorted(set(self.rot_terms[start:end]))
+
+        terms = self.terms
+        if(len(pieces) == 2 and pattern[len(prefix)] == '*'):
+            # P*S: todos los terminos del rango encajan
+            return [terms[tid] for tid in tids]
+
+        regex = re.compile(''.join('.*' if char == '*' else '.' if char == '?' else re.escape(char)
+                                    for char in pattern))
+        return [terms[tid] for tid in tids if regex.fullmatch(terms[tid])]
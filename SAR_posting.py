@@ -0,0 +1,558 @@
+from array import array
+from bisect import bisect_left
+
+try:
+    import numpy as np
+except ImportError: # numpy es opcional, solo lo necesita el motor "numpy"
+    np = None
+
+
+# numero de newids por bloque de los skip pointers
+SKIP = 64
+
+
+class Posting:
+    """
+    Posting list compacta de un termino.
+
+    En lugar de un diccionario {(docid, newid): [posiciones]} se guardan tres arrays de enteros:
+        - newids: newid de las noticias que contienen el termino, ordenados
+        - offsets: offsets[i]:offsets[i+1] es el rango de "positions" de la noticia newids[i]
+        - positions: posiciones del termino en cada noticia, concatenadas
+        - skips: skip pointers, el mayor newid de cada bloque de SKIP newids, para saltar
+                 bloques enteros al intersectar (ver seek)
+
+    Como las noticias se indexan en orden creciente de newid, añadir siempre es un append.
+
+    """
+
+    __slots__ = ('newids', 'offsets', 'positions', 'skips')
+
+    def __init__(self, newids=None, offsets=None, positions=None, skips=None):
+        self.newids = array('I') if newids is None else newids
+        self.offsets = array('I', (0,)) if offsets is None else offsets
+        self.positions = array('I') if positions is None else positions
+        self.skips = skips
+
+
+    def __len__(self):
+        return len(self.newids)
+
+
+    def __iter__(self):
+        return iter(self.newids)
+
+
+    def __contains__(self, newid):
+        return self.find(newid) != -1
+
+
+    def __eq__(self, other):
+        return (isinstance(other, Posting) and self.newids == other.newids
+                and self.offsets == other.offsets and self.positions == other.positions)
+
+
+    def add(self, newid, pos):
+        """
+        Añade la posicion "pos" del termino en la noticia "newid".
+
+        param:  "newid": noticia, mayor o igual que la ultima añadida
+                "pos": posicion del termino en la noticia
+
+        return: True si es la primera aparicion del termino en la noticia
+
+        """
+        newids = self.newids
+        first = not newids or newids[-1] != newid
+        if(first):
+            newids.append(newid)
+            self.offsets.append(self.offsets[-1])
+        self.positions.append(pos)
+        self.offsets[-1] += 1
+        return first
+
+
+    def extend(self, other, newid_off=0):
+        """
+        Añade al final la posting "other" desplazando sus newid en "newid_off".
+        Todos los newid de "other" (desplazados) deben ser mayores que los de esta posting.
+
+        """
+        base = self.offsets[-1]
+        self.newids.extend(newid + newid_off for newid in other.newids)
+        self.offsets.extend(offset + base for offset in other.offsets[1:])
+        self.positions.extend(other.positions)
+
+
+    def make_skips(self):
+        """
+        Calcula los skip pointers (el ultimo newid de cada bloque completo de SKIP newids).
+
+        """
+        self.skips = self.newids[SKIP-1::SKIP]
+        return self.skips
+
+
+    def seek(self, newid, lo=0):
+        """
+        Primer indice i >= lo tal que self.newids[i] >= newid.
+
+        Con los skip pointers se salta directamente al bloque que puede contener "newid"
+        y solo se busca dentro de ese bloque.
+
+        """
+        newids = self.newids
+        n = len(newids)
+        if(lo >= n or newids[lo] >= newid):
+            return lo
+
+        skips = self.skips
+        if(skips is None or len(skips) != n // SKIP): # no calculados o la posting ha crecido
+            skips = self.make_skips()
+
+        block = bisect_left(skips, newid, lo // SKIP)
+        start = max(lo, block * SKIP)
+        return bisect_left(newids, newid, start, min(block * SKIP + SKIP, n))
+
+
+    def find(self, newid, lo=0):
+        """
+        Busca "newid" en la posting a partir del indice "lo".
+
+        return: indice de "newid" en self.newids o -1 si no esta
+
+        """
+        i = self.seek(newid, lo)
+        if(i < len(self.newids) and self.newids[i] == newid):
+            return i
+        return -1
+
+
+    def positions_at(self, i):
+        """
+        Devuelve las posiciones de la i-esima noticia de la posting.
+
+        """
+        return self.positions[self.offsets[i]:self.offsets[i+1]]
+
+
+    def slice(self, lo, hi=None):
+        """
+        Copia de las noticias newids[lo:hi] de la posting, con sus posiciones.
+
+        """
+        if(hi is None):
+            hi = len(self.newids)
+        base = self.offsets[lo]
+        if(base):
+            offsets = array('I', (offset - base for offset in self.offsets[lo:hi+1]))
+        else:
+            offsets = self.offsets[lo:hi+1]
+        return Posting(self.newids[lo:hi], offsets, self.positions[base:self.offsets[hi]])
+
+
+    def get(self, newid, default=None):
+        """
+        Devuelve las posiciones del termino en la noticia "newid", o "default" si no aparece.
+
+        """
+        i = self.find(newid)
+        if(i == -1):
+            return default
+        return self.positions_at(i)
+
+
+
+def union(postings):
+    """
+    Posting con todas las noticias y posiciones de "postings", postings de terminos
+    distintos (no comparten posiciones) como los que tienen el mismo stem.
+
+    Recorre las postings a la vez en orden de newid, con un cursor por posting.
+
+    param:  "postings": lista de Posting
+
+    return: Posting nueva
+
+    """
+    if(len(postings) == 1):
+        return postings[0].slice(0)
+
+    result = Posting()
+    newids, offsets, positions = result.newids, result.offsets, result.positions
+    cursors = [0] * len(postings)
+    for newid in sorted(set().union(*(posting.newids for posting in postings))):
+        merged = []
+        for i, posting in enumerate(postings):
+            c = cursors[i]
+            if(c < len(posting.newids) and posting.newids[c] == newid):
+                merged.extend(posting.positions_at(c))
+                cursors[i] = c + 1
+        merged.sort()
+        newids.append(newid)
+        positions.extend(merged)
+        offsets.append(len(positions))
+    return result
+
+
+
+def position_masks(posting):
+    """
+    Posiciones de cada noticia de "posting" como un entero con el bit p activo si el termino
+    esta en la posicion p. Con ellas una frase "t0 t1 ... tk" aparece en una noticia si
+    mask(t0) & (mask(t1) >> 1) & ... & (mask(tk) >> k) no es 0, con operaciones en C.
+
+    param:  "posting": Posting
+
+    return: {newid: mascara}
+
+    """
+    positions = posting.positions
+    offsets = posting.offsets
+    bit = (1).__lshift__
+    return dict(zip(posting.newids, (sum(map(bit, positions[lo:hi]))
+                                        for lo, hi in zip(offsets, offsets[1:]))))
+
+
+
+def mask_phrase(masks):
+    """
+    Noticias con la frase cuyos terminos tienen las mascaras "masks" (position_masks),
+    recorriendo la mas corta.
+
+    return: array con los newids, ordenados
+
+    """
+    result = array('I')
+    for newid in min(masks, key=len):
+        match = -1
+        for k, term_masks in enumerate(masks):
+            match &= term_masks.get(newid, 0) >> k
+            if(not match):
+                break
+        if(match):
+            result.append(newid)
+    return result
+
+
+
+def _spread(bits, width):
+    """
+    OR de bits >> s para s en [0, width), con log(width) desplazamientos.
+
+    """
+    done = 1
+    while done < width:
+        step = min(done, width - done)
+        bits |= bits >> step
+        done += step
+    return bits
+
+
+
+def mask_near(left, right, distance, ordered=False):
+    """
+    Lo mismo que near_match para todas las noticias, con las mascaras de posiciones de los
+    dos terminos (position_masks): se extienden las posiciones de "right" a su ventana y se
+    intersectan con las de "left".
+
+    return: array con los newids, ordenados
+
+    """
+    result = array('I')
+    if(distance < 1):
+        return result
+    # si los dos terminos son el mismo, basta con buscar otra aparicion despues de cada una
+    same = left is right
+    smaller, other = (left, right) if len(left) <= len(right) else (right, left)
+    for newid in smaller:
+        if(newid not in other):
+            continue
+        r = right[newid]
+        if(ordered or same):
+            window = _spread(r, distance) >> 1
+        else:
+            window = _spread(r << distance, 2 * distance + 1)
+        if(left[newid] & window):
+            result.append(newid)
+    return result
+
+
+
+def skip_and(p, posting):
+    """
+    AND de la posting list "p" con el Posting "posting" usando sus skip pointers:
+    por cada newid de "p" se salta en "posting" directamente al bloque donde puede estar.
+    Util cuando "p" es mucho mas corta que "posting".
+
+    """
+    result = array('I')
+    newids = posting.newids
+    n = len(newids)
+    j = 0
+    for newid in p:
+        j = posting.seek(newid, j)
+        if(j == n):
+            break
+        if(newids[j] == newid):
+            result.append(newid)
+            j += 1
+    return result
+
+
+
+def phrase_match(positions):
+    """
+    Indica si hay una frase: una posicion p tal que p + k esta en positions[k] para todo k.
+
+    Merge lineal de las listas ordenadas de posiciones (una por cada termino de la frase, los
+    terminos repetidos pueden compartir la misma lista): se mantiene un inicio candidato y se
+    avanza cada cursor hasta su posicion esperada; si se pasa, el inicio salta hacia delante.
+
+    param:  "positions": lista de listas ordenadas de posiciones, una por termino
+
+    return: True si la frase aparece
+
+    """
+    nterms = len(positions)
+    cursors = [0] * nterms
+    if(not positions[0]):
+        return False
+
+    start = positions[0][0]
+    matched = 0
+    k = 0
+    while True:
+        current = positions[k]
+        c = bisect_left(current, start + k, cursors[k])
+        if(c == len(current)):
+            return False
+        cursors[k] = c
+
+        if(current[c] == start + k):
+            matched += 1
+        else:
+            # la posicion de este termino fija el nuevo inicio
+            start = current[c] - k
+            matched = 1
+
+        if(matched == nterms):
+            return True
+        k = (k + 1) % nterms
+
+
+
+def near_match(left, right, distance, ordered=False):
+    """
+    Indica si hay una posicion de "right" a "distance" posiciones o menos de una de "left"
+    (despues de ella si "ordered"). Si los dos terminos son el mismo, deben ser apariciones distintas.
+
+    Ventana deslizante sobre las dos listas ordenadas: el cursor de "right" solo avanza,
+    asi que el coste es lineal en las posiciones recorridas.
+
+    param:  "left", "right": listas ordenadas de posiciones
+            "distance": distancia maxima
+            "ordered": si "right" debe ir despues de "left"
+
+    return: True si hay alguna pareja dentro de la ventana
+
+    """
+    nright = len(right)
+    j = 0
+    for pos in left:
+        j = bisect_left(right, pos + 1 if ordered else pos - distance, j)
+        if(j == nright):
+            return False
+        other = right[j]
+        if(other == pos): # la misma aparicion, se mira la siguiente
+            if(j + 1 == nright):
+                continue
+            other = right[j + 1]
+        if(other <= pos + distance):
+            return True
+    return False
+
+
+
+###############################
+###                         ###
+###  MOTORES DE CONJUNTOS   ###
+###                         ###
+###############################
+
+# Operaciones AND/OR/NOT sobre listas ordenadas de newids (sin repetidos),
+# alternativas al merge de dos punteros de SAR_Project.and_posting, etc.
+#   - "gallop": recorre la lista mas corta y busca en la larga con busqueda exponencial,
+#               copiando los tramos intermedios con slices (en C)
+#   - "numpy": las mismas operaciones vectorizadas con np.searchsorted
+
+
+def _gallop(seq, value, lo):
+    """
+    Busqueda exponencial: primer indice i >= lo tal que seq[i] >= value.
+
+    """
+    n = len(seq)
+    hi = lo
+    step = 1
+    while hi < n and seq[hi] < value:
+        lo = hi + 1
+        hi += step
+        step <<= 1
+    return bisect_left(seq, value, lo, min(hi, n))
+
+
+def gallop_and(p1, p2):
+    if(len(p1) > len(p2)):
+        p1, p2 = p2, p1
+
+    result = array('I')
+    n = len(p2)
+    j = 0
+    for newid in p1:
+        j = _gallop(p2, newid, j)
+        if(j == n):
+            break
+        if(p2[j] == newid):
+            result.append(newid)
+            j += 1
+    return result
+
+
+def gallop_or(p1, p2):
+    if(len(p1) > len(p2)):
+        p1, p2 = p2, p1
+
+    result = array('I')
+    n = len(p2)
+    j = 0
+    for newid in p1:
+        k = _gallop(p2, newid, j)
+        result.extend(p2[j:k])
+        result.append(newid)
+        j = k + 1 if k < n and p2[k] == newid else k
+    result.extend(p2[j:])
+    return result
+
+
+def gallop_minus(p1, p2):
+    result = array('I')
+    if(len(p1) <= len(p2)):
+        n = len(p2)
+        j = 0
+        for newid in p1:
+            j = _gallop(p2, newid, j)
+            if(j == n or p2[j] != newid):
+                result.append(newid)
+    else:
+        n = len(p1)
+        i = 0
+        for newid in p2:
+            k = _gallop(p1, newid, i)
+            result.extend(p1[i:k])
+            i = k + 1 if k < n and p1[k] == newid else k
+        result.extend(p1[i:])
+    return result
+
+
+def _to_numpy(p):
+    if(isinstance(p, array) and p.typecode == 'I'):
+        return np.frombuffer(p, dtype=np.uint32)
+    return np.asarray(p, dtype=np.uint32)
+
+
+def _from_numpy(a):
+    result = array('I')
+    result.frombytes(a.astype(np.uint32, copy=False).tobytes())
+    return result
+
+
+def _numpy_member(a, b):
+    """
+    Mascara de los elementos de "a" que estan en "b" (ambos ordenados).
+
+    """
+    if(len(b) == 0):
+        return np.zeros(len(a), dtype=bool)
+    idx = np.searchsorted(b, a)
+    np.minimum(idx, len(b) - 1, out=idx)
+    return b[idx] == a
+
+
+def numpy_and(p1, p2):
+    a, b = _to_numpy(p1), _to_numpy(p2)
+    if(len(a) > len(b)):
+        a, b = b, a
+    return _from_numpy(a[_numpy_member(a, b)])
+
+
+def numpy_or(p1, p2):
+    # np.union1d pasa por np.unique, mucho mas lento que ordenar (radix
+    # sort para enteros) y quitar repetidos consecutivos
+    merged = np.concatenate((_to_numpy(p1), _to_numpy(p2)))
+    merged.sort(kind='stable')
+    if(len(merged) == 0):
+        return _from_numpy(merged)
+    keep = np.empty(len(merged), dtype=bool)
+    keep[0] = True
+    np.not_equal(merged[1:], merged[:-1], out=keep[1:])
+    return _from_numpy(merged[keep])
+
+
+def numpy_minus(p1, p2):
+    a, b = _to_numpy(p1), _to_numpy(p2)
+    return _from_numpy(a[~_numpy_member(a, b)])
+
+
+# motor -> (AND, OR, AND NOT). "merge" es el de SAR_Project y no esta aqui.
+ENGINES = {
+    "gallop": (gallop_and, gallop_or, gallop_minus),
+}
+if np is not None:
+    ENGINES["numpy"] = (numpy_and, numpy_or, numpy_minus)
+
+
+
+###############################
+###                         ###
+###         BITMAPS         ###
+###                         ###
+###############################
+
+# Conjuntos de newids como bitmaps (enteros de Python, el bit i indica si esta la noticia i).
+# El complemento respecto al universo de noticias es un "universo & ~bitmap",
+# sin ordenar ni recorrer la lista de noticias.
+
+# posiciones de los bits a 1 de cada byte
+_BYTE_BITS = tuple(tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256))
+
+
+def to_bitmap(p):
+    """
+    Bitmap con los newids de la posting list "p".
+
+    """
+    if(not len(p)):
+        return 0
+    bits = bytearray(max(p) // 8 + 1)
+    for newid in p:
+        bits[newid >> 3] |= 1 << (newid & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def from_bitmap(bits):
+    """
+    Posting list ordenada con los newids del bitmap "bits".
+
+    """
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    if np is not None:
+        return _from_numpy(np.flatnonzero(
+                np.unpackbits(np.frombuffer(data, dtype=np.uint8), bitorder='little')))
+
+    result = array('I')
+    for nbyte, byte in enumerate(data):
+        if(byte):
+            base = nbyte << 3
+            result.extend(base + bit for bit in _BYTE_BITS[byte])
+    return result
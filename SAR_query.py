@@ -0,0 +1,351 @@
+"""
+Parser y planificador de consultas de SAR_Project.
+
+Una consulta se convierte en un arbol (AST) de tuplas con nombre, hashables para poder usarlas como clave:
+
+    Term(field, term)           termino
+    Wildcard(field, pattern)    termino con comodines (* o ?)
+    Fuzzy(field, term, distance)
+                                terminos a "distance" ediciones o menos de "term" (termino~k)
+    Phrase(field, terms)        terminos consecutivos ("...")
+    Near(field, left, right, distance, ordered)
+                                dos terminos a "distance" posiciones o menos (NEAR/k),
+                                con "left" antes que "right" si "ordered" (ONEAR/k)
+    Not(child)
+    And(children)
+    Or(children)
+
+Gramatica (AND y OR tienen la misma precedencia y se evaluan de izquierda a derecha,
+como hacia la version anterior; dos operandos seguidos sin operador son un AND):
+
+    expr    := unary (("AND" | "OR")? unary)*
+    unary   := "NOT" unary | atom
+    atom    := "(" expr ")" | [campo:]"termino termino ..." | near
+    near    := [campo:]termino (("NEAR/k" | "ONEAR/k") [campo:]termino)?
+
+Un termino terminado en "~k" (o "~", k = 1) es una busqueda aproximada.
+
+"""
+
+import re
+from collections import namedtuple
+
+
+Term = namedtuple("Term", "field term")
+Wildcard = namedtuple("Wildcard", "field pattern")
+Fuzzy = namedtuple("Fuzzy", "field term distance")
+Phrase = namedtuple("Phrase", "field terms")
+Near = namedtuple("Near", "field left right distance ordered")
+Not = namedtuple("Not", "child")
+And = namedtuple("And", "children")
+Or = namedtuple("Or", "children")
+
+OPERATORS = {"AND", "OR", "NOT"}
+
+_WORD = re.compile(r'(?:([^\s()":]+):)?(?:"([^"]*)("?)|([^\s()"]+))')
+_WILDCARD = re.compile(r"[?*]")
+_NEAR = re.compile(r"(O?NEAR)/(\d+)$")
+_FUZZY = re.compile(r"([^~]+)~(\d*)")
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+
+def tokenize(query):
+    """
+    Divide la consulta en parentesis, operadores y operandos.
+
+    return: lista de "(", ")", "AND", "OR", "NOT", ("NEAR", k, ordenado) o tuplas (campo, termino, es_frase)
+
+    """
+    tokens = []
+    i = 0
+    while i < len(query):
+        char = query[i]
+        if(char.isspace()):
+            i += 1
+        elif(char in "()"):
+            tokens.append(char)
+            i += 1
+        else:
+            match = _WORD.match(query, i)
+            if(match is None):
+                raise QuerySyntaxError(f"Caracter inesperado en la posicion {i}: '{char}'")
+            field, phrase, closed, term = match.groups()
+            if(phrase is not None):
+                if(not closed):
+                    raise QuerySyntaxError("Falta cerrar las comillas")
+                tokens.append((field, phrase, True))
+            elif(field is None and term in OPERATORS):
+                tokens.append(term)
+            elif(field is None and _NEAR.match(term)):
+                operator, distance = _NEAR.match(term).groups()
+                tokens.append(("NEAR", int(distance), operator == "ONEAR"))
+            else:
+                tokens.append((field, term, False))
+            i = match.end()
+    return tokens
+
+
+
+def parse(query, fields=None, default_field="article"):
+    """
+    Convierte la consulta en un AST.
+
+    param:  "query": cadena con la consulta
+            "fields": campos validos, si es None se acepta cualquiera
+            "default_field": campo de los terminos sin prefijo
+
+    return: AST de la consulta
+
+    """
+    tokens = tokenize(query)
+    if(not tokens):
+        raise QuerySyntaxError("Consulta vacia")
+
+    parser = _Parser(tokens, fields, default_field)
+    node = parser.expr()
+    if(parser.pos != len(tokens)):
+        raise QuerySyntaxError(f"Token inesperado: '{tokens[parser.pos]}'")
+    return simplify(node)
+
+
+
+class _Parser:
+
+    def __init__(self, tokens, fields, default_field):
+        self.tokens = tokens
+        self.pos = 0
+        self.fields = fields
+        self.default_field = default_field
+
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+
+    def next(self):
+        token = self.peek()
+        if(token is None):
+            raise QuerySyntaxError("Final de consulta inesperado")
+        self.pos += 1
+        return token
+
+
+    def expr(self):
+        node = self.unary()
+        while True:
+            token = self.peek()
+            if(token is None or token == ")"):
+                return node
+            if(token in ("AND", "OR")):
+                self.pos += 1
+            cls = Or if token == "OR" else And
+            right = self.unary()
+            if(type(node) is cls):
+                node = cls(node.children + (right,))
+            else:
+                node = cls((node, right))
+
+
+    def unary(self):
+        token = self.next()
+        if(token == "NOT"):
+            return Not(self.unary())
+        if(token == "("):
+            node = self.expr()
+            if(self.next() != ")"):
+                raise QuerySyntaxError("Falta cerrar un parentesis")
+            return node
+        if(token in (")", "AND", "OR") or token[0] == "NEAR"):
+            raise QuerySyntaxError(f"Token inesperado: '{token}'")
+
+        near = self.peek()
+        if(near is None or near[0] != "NEAR"):
+            return self.operand(*token)
+
+        self.pos += 1
+        right = self.next()
+        if(token[2] or isinstance(right, str) or right[0] == "NEAR" or right[2]):
+            raise QuerySyntaxError("NEAR/k solo se puede usar entre dos terminos")
+        _, distance, ordered = near
+        # el campo explicito de un operando se aplica tambien al otro
+        field = token[0] or right[0]
+        if(token[0] and right[0] and token[0].lower() != right[0].lower()):
+            raise QuerySyntaxError("Los terminos de NEAR/k deben ser del mismo campo")
+        left = self.operand(field, token[1], False)
+        right = self.operand(field, right[1], False)
+        if(type(left) is not Term or type(right) is not Term):
+            raise QuerySyntaxError("NEAR/k no admite comodines ni busquedas aproximadas")
+        if(distance < 1):
+            raise QuerySyntaxError("La distancia de NEAR/k debe ser al menos 1")
+        return Near(left.field, left.term, right.term, distance, ordered)
+
+
+    def operand(self, field, text, is_phrase):
+        field = field.lower() if field else self.default_field
+        if(self.fields is not None and field not in self.fields):
+            raise QuerySyntaxError(f"Campo desconocido: '{field}'")
+
+        text = text.lower()
+        if(is_phrase):
+            terms = tuple(text.split())
+            if(not terms):
+                raise QuerySyntaxError("Frase vacia")
+            if(len(terms) > 1):
+                return Phrase(field, terms)
+            text = terms[0]
+
+        fuzzy = _FUZZY.fullmatch(text)
+        if(fuzzy is not None):
+            term, distance = fuzzy.groups()
+            if(_WILDCARD.search(term)):
+                raise QuerySyntaxError("Una busqueda aproximada (~) no admite comodines")
+            return Fuzzy(field, term, int(distance or 1))
+        if("~" in text):
+            raise QuerySyntaxError(f"Busqueda aproximada incorrecta: '{text}'")
+
+        if(_WILDCARD.search(text)):
+            return Wildcard(field, text)
+        return Term(field, text)
+
+
+
+def simplify(node):
+    """
+    Normaliza el AST: elimina las dobles negaciones y aplana los AND/OR anidados.
+
+    """
+    cls = type(node)
+    if(cls is Not):
+        child = simplify(node.child)
+        if(type(child) is Not):
+            return child.child
+        return Not(child)
+
+    if(cls in (And, Or)):
+        children = []
+        for child in map(simplify, node.children):
+            if(type(child) is cls):
+                children.extend(child.children)
+            else:
+                children.append(child)
+        return cls(tuple(children))
+
+    return node
+
+
+
+def normalize(node):
+    """
+    Forma canonica de un nodo, para usarla como clave: los operandos de los AND y OR
+    no dependen del orden ("a AND b" y "b AND a" tienen la misma).
+
+    Cada nivel empieza por el nombre del tipo del nodo, porque las tuplas con nombre se
+    comparan como tuplas normales y And((a, b)) seria igual a Or((a, b)).
+
+    """
+    cls = type(node)
+    if(cls is Not):
+        return (cls.__name__, normalize(node.child))
+    if(cls in (And, Or)):
+        return (cls.__name__, frozenset(map(normalize, node.children)))
+    return (cls.__name__,) + tuple(node)
+
+
+
+def plan(node, estimate):
+    """
+    Reordena el AST segun el coste estimado de cada nodo.
+
+    En los AND, los operandos positivos se ordenan de menor a mayor cardinalidad (se intersecta
+    primero lo mas pequeño) y los NOT se dejan al final, para resolverlos como diferencias.
+
+    param:  "node": AST
+            "estimate": funcion que devuelve la cardinalidad estimada de un nodo
+
+    return: AST reordenado
+
+    """
+    cls = type(node)
+    if(cls is Not):
+        return Not(plan(node.child, estimate))
+
+    if(cls is And):
+        children = [plan(child, estimate) for child in node.children]
+        positives = sorted((child for child in children if type(child) is not Not), key=estimate)
+        # las diferencias que mas quitan primero
+        negatives = sorted((child for child in children if type(child) is Not),
+                            key=lambda child: estimate(child.child), reverse=True)
+        return And(tuple(positives + negatives))
+
+    if(cls is Or):
+        return Or(tuple(plan(child, estimate) for child in node.children))
+
+    return node
+
+
+
+def explain(node, estimate, depth=0):
+    """
+    Representacion en texto del plan, con la cardinalidad estimada de cada nodo.
+
+    """
+    indent = "    " * depth
+    cls = type(node)
+
+    if(cls is Term):
+        line = f"TERM {node.field}:{node.term}"
+    elif(cls is Wildcard):
+        line = f"WILDCARD {node.field}:{node.pattern}"
+    elif(cls is Fuzzy):
+        line = f"FUZZY {node.field}:{node.term}~{node.distance}"
+    elif(cls is Phrase):
+        line = f"PHRASE {node.field}:\"{' '.join(node.terms)}\""
+    elif(cls is Near):
+        line = f"{'ONEAR' if node.ordered else 'NEAR'}/{node.distance} {node.field}:{node.left} {node.field}:{node.right}"
+    elif(cls is Not):
+        line = "NOT (complement)"
+    elif(cls is And):
+        line = "AND" if type(node.children[0]) is not Not else "AND (complement of the union)"
+    else:
+        line = "OR"
+
+    lines = [f"{indent}{line}  ~{estimate(node)}"]
+
+    if(cls is Not):
+        lines.append(explain(node.child, estimate, depth + 1))
+    elif(cls is And and type(node.children[0]) is Not):
+        for child in node.children:
+            lines.append(explain(child.child, estimate, depth + 1))
+    elif(cls in (And, Or)):
+        for child in node.children:
+            if(cls is And and type(child) is Not):
+                lines.append(f"{indent}    MINUS  ~{estimate(child.child)}")
+                lines.append(explain(child.child, estimate, depth + 2))
+            else:
+                lines.append(explain(child, estimate, depth + 1))
+
+    return "\n".join(lines)
+
+
+
+def positive_terms(node):
+    """
+    Terminos de la consulta que no estan negados, para los snippets y el ranking.
+
+    return: lista de (campo, termino)
+
+    """
+    cls = type(node)
+    if(cls is Term):
+        return [(node.field, node.term)]
+    if(cls is Phrase):
+        return [(node.field, term) for term in node.terms]
+    if(cls is Near):
+        return [(node.field, node.left), (node.field, node.right)]
+    if(cls in (And, Or)):
+        return [term for child in node.children for term in positive_terms(child)]
+    return []
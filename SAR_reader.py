@@ -0,0 +1,75 @@
+"""
+Lectura en streaming de los ficheros de noticias de SAR_Project.
+
+En lugar de cargar el fichero entero con json.load, se lee por bloques y se decodifica
+noticia a noticia, de forma que en memoria solo hay un bloque y la noticia actual.
+Acepta los dos formatos:
+
+    - JSON Array: [{noticia}, {noticia}, ...]
+    - JSON Lines: una noticia por linea (o, en general, noticias separadas por espacios)
+
+"""
+
+import json
+
+
+CHUNK_SIZE = 1 << 16
+
+_decoder = json.JSONDecoder()
+
+
+def read_news(filename, chunk_size=CHUNK_SIZE):
+    """
+    Devuelve, una a una, las noticias de "filename".
+
+    param:  "filename": fichero JSON Array o JSON Lines
+            "chunk_size": caracteres que se leen de cada vez
+
+    return: generador de diccionarios, uno por noticia
+
+    """
+    with open(filename, encoding='utf-8') as fh:
+        buf = ""
+        pos = 0
+        eof = False
+        is_array = None
+
+        while True:
+            # saltar espacios (y comas entre elementos del array)
+            while pos < len(buf) and (buf[pos].isspace() or (is_array and buf[pos] == ',')):
+                pos += 1
+
+            if(pos == len(buf)):
+                if(eof):
+                    if(is_array):
+                        raise ValueError(f"'{filename}': falta cerrar el array")
+                    return
+                buf = fh.read(chunk_size)
+                pos = 0
+                eof = not buf
+                continue
+
+            if(is_array is None):
+                is_array = buf[pos] == '['
+                if(is_array):
+                    pos += 1
+                continue
+
+            if(is_array and buf[pos] == ']'):
+                return
+
+            try:
+                news, end = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if(eof):
+                    raise
+                # noticia incompleta: se lee mas (al menos tanto como hay, para no repetir
+                # muchas veces el intento con una noticia muy larga)
+                more = fh.read(max(chunk_size, len(buf) - pos))
+                buf = buf[pos:] + more
+                pos = 0
+                eof = not more
+                continue
+
+            yield news
+            pos = end
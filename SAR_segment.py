@@ -0,0 +1,349 @@
+"""
+Formato de segmento en disco para el indice de SAR_Project.
+
+En vez de guardar todo el objeto con pickle, el indice invertido (index y sindex) y las noticias
+se escriben en un fichero que el buscador abre con mmap y decodifica bajo demanda, termino a termino:
+
+    MAGIC | offset del directorio (uint64) | secciones ... | directorio (pickle)
+
+    - Diccionario de terminos (uno por campo de index y de sindex):
+        postings:   para cada termino, los arrays newids, offsets, positions y skips seguidos
+        terminos:   los terminos en utf-8, concatenados
+        tabla:      un registro TERM_RECORD por termino, ordenados por termino, para busqueda binaria
+    - Noticias: cada noticia en pickle y una tabla de offsets uint64 indexada por newid
+    - Snippets: el texto comprimido de cada articulo (SAR_snippet), con una tabla de offsets
+      igual que la de las noticias
+    - Blobs: el resto de estructuras grandes (iindex, weight...) en pickles independientes,
+      que solo se cargan si se utilizan
+    - Directorio: donde esta cada seccion y los atributos pequeños del objeto (configuracion, docs...)
+
+"""
+
+import mmap
+import pickle
+import struct
+import sys
+from array import array
+from operator import sub
+
+from SAR_posting import Posting, SKIP
+
+
+# cambia con cada cambio de formato (secciones, registros o tipos de los blobs): los
+# segmentos de otra version no se abren y hay que volver a crear el indice
+MAGIC = b"SARSEG05"
+HEADER = struct.Struct("<Q")
+# offset del termino, longitud del termino, offset de la posting, numero de noticias, numero de posiciones,
+# maxima frecuencia del termino en una noticia (para las cotas del ranking top-k)
+TERM_RECORD = struct.Struct("<QIQIII")
+
+
+
+def write_segment(filename, state, index, sindex, news, snippets, blobs):
+    """
+    Escribe un segmento.
+
+    param:  "filename": fichero de salida
+            "state": diccionario con los atributos pequeños del objeto
+            "index", "sindex": {campo: {termino: Posting}}
+            "news": {newid: tupla de la noticia}, con newid de 0 a len(news)-1
+            "snippets": {newid: bytes de SAR_snippet.encode}, con los mismos newid que "news"
+            "blobs": {nombre: estructura} que se guardan en pickles independientes
+
+    """
+    with open(filename, 'wb') as fh:
+        fh.write(MAGIC)
+        fh.write(HEADER.pack(0))
+
+        directory = {
+            "byteorder": sys.byteorder,
+            "state": state,
+            "index": dict((field, _write_terms(fh, token_dict)) for field, token_dict in index.items()),
+            "sindex": dict((field, _write_terms(fh, token_dict)) for field, token_dict in sindex.items()),
+            "news": _write_records(fh, news, _pickle),
+            "snippets": _write_records(fh, snippets, bytes),
+            "blobs": dict((name, _write_blob(fh, value)) for name, value in blobs.items()),
+        }
+
+        directory_off = fh.tell()
+        pickle.dump(directory, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        fh.seek(len(MAGIC))
+        fh.write(HEADER.pack(directory_off))
+
+
+def _write_terms(fh, token_dict):
+    terms = sorted(token_dict)
+    records = []
+
+    for term in terms:
+        posting = token_dict[term]
+        post_off = fh.tell()
+        posting.newids.tofile(fh)
+        posting.offsets.tofile(fh)
+        posting.positions.tofile(fh)
+        posting.make_skips().tofile(fh)
+        offsets = posting.offsets
+        max_tf = max(map(sub, offsets[1:], offsets), default=0)
+        records.append([0, 0, post_off, len(posting.newids), len(posting.positions), max_tf])
+
+    for record, term in zip(records, terms):
+        encoded = term.encode('utf-8')
+        record[0] = fh.tell()
+        record[1] = len(encoded)
+        fh.write(encoded)
+
+    table_off = fh.tell()
+    for record in records:
+        fh.write(TERM_RECORD.pack(*record))
+
+    return (table_off, len(terms))
+
+
+def _pickle(value):
+    return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _write_records(fh, records, encode):
+    offsets = array('Q')
+    for newid in range(len(records)):
+        offsets.append(fh.tell())
+        fh.write(encode(records[newid]))
+    offsets.append(fh.tell())
+
+    table_off = fh.tell()
+    offsets.tofile(fh)
+    return (table_off, len(records))
+
+
+def _write_blob(fh, value):
+    off = fh.tell()
+    pickle.dump(value, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    return (off, fh.tell() - off)
+
+
+
+class Segment:
+    """
+    Segmento abierto con mmap.
+
+    Solo se lee el directorio al abrirlo, el resto se decodifica bajo demanda.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[:len(MAGIC)] != MAGIC:
+            if self.mm[:len(MAGIC) - 2] == MAGIC[:-2]:
+                raise ValueError(f"'{filename}' es un segmento de una version anterior"
+                                 f" ({self.mm[:len(MAGIC)].decode('ascii', 'replace')}, se necesita"
+                                 f" {MAGIC.decode('ascii')}): vuelve a crear el indice con SAR_Indexer")
+            raise ValueError(f"'{filename}' no es un segmento de SAR_Project (los indices guardados"
+                             f" con pickle por versiones anteriores ya no se abren): vuelve a crear"
+                             f" el indice con SAR_Indexer")
+
+        directory_off, = HEADER.unpack_from(self.mm, len(MAGIC))
+        directory = pickle.loads(self.mm[directory_off:])
+
+        self.swap = directory["byteorder"] != sys.byteorder
+        self.state = directory["state"]
+        self.index = dict((field, SegmentTerms(self, *section))
+                            for field, section in directory["index"].items())
+        self.sindex = dict((field, SegmentTerms(self, *section))
+                            for field, section in directory["sindex"].items())
+        self.news = SegmentNews(self, *directory["news"])
+        self.snippets = SegmentNews(self, *directory["snippets"], decode=bytes)
+        self.blobs = directory["blobs"]
+
+
+    def array(self, typecode, start, count):
+        """
+        Decodifica "count" elementos de tipo "typecode" a partir de "start".
+
+        """
+        result = array(typecode)
+        result.frombytes(self.mm[start:start + count * result.itemsize])
+        if(self.swap):
+            result.byteswap()
+        return result
+
+
+    def load_blob(self, name):
+        """
+        Decodifica la estructura "name" guardada como pickle.
+
+        """
+        off, length = self.blobs[name]
+        return pickle.loads(self.mm[off:off + length])
+
+
+    def close(self):
+        self.mm.close()
+
+
+
+class SegmentTerms:
+    """
+    Diccionario {termino: Posting} de solo lectura sobre un segmento.
+
+    Las busquedas son binarias sobre la tabla de registros ordenada,
+    y solo se decodifica la posting del termino pedido.
+
+    """
+
+    def __init__(self, segment, table_off, count):
+        self.segment = segment
+        self.table_off = table_off
+        self.count = count
+
+
+    def __len__(self):
+        return self.count
+
+
+    def _record(self, i):
+        return TERM_RECORD.unpack_from(self.segment.mm, self.table_off + i * TERM_RECORD.size)
+
+
+    def _term(self, record):
+        return self.segment.mm[record[0]:record[0] + record[1]].decode('utf-8')
+
+
+    def _posting(self, record):
+        segment = self.segment
+        _, _, post_off, ndocs, npos, _ = record
+        newids = segment.array('I', post_off, ndocs)
+        post_off += ndocs * newids.itemsize
+        offsets = segment.array('I', post_off, ndocs + 1)
+        post_off += (ndocs + 1) * offsets.itemsize
+        positions = segment.array('I', post_off, npos)
+        post_off += npos * positions.itemsize
+        skips = segment.array('I', post_off, ndocs // SKIP)
+        return Posting(newids, offsets, positions, skips)
+
+
+    def _find(self, term):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if(self._term(self._record(mid)) < term):
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if(lo < self.count):
+            record = self._record(lo)
+            if(self._term(record) == term):
+                return record
+        return None
+
+
+    def get(self, term, default=None):
+        record = self._find(term)
+        if(record is None):
+            return default
+        return self._posting(record)
+
+
+    def __getitem__(self, term):
+        record = self._find(term)
+        if(record is None):
+            raise KeyError(term)
+        return self._posting(record)
+
+
+    def __contains__(self, term):
+        return self._find(term) is not None
+
+
+    def df(self, term):
+        """
+        Numero de noticias de la posting de "term", sin decodificarla.
+
+        """
+        record = self._find(term)
+        return record[3] if record is not None else 0
+
+
+    def max_tf(self, term):
+        """
+        Maxima frecuencia de "term" en una noticia, sin decodificar su posting.
+
+        """
+        record = self._find(term)
+        return record[5] if record is not None else 0
+
+
+    def keys(self):
+        for i in range(self.count):
+            yield self._term(self._record(i))
+
+
+    __iter__ = keys
+
+
+    def items(self):
+        for i in range(self.count):
+            record = self._record(i)
+            yield self._term(record), self._posting(record)
+
+
+    def values(self):
+        for _, posting in self.items():
+            yield posting
+
+
+
+class SegmentNews:
+    """
+    Diccionario {newid: noticia} de solo lectura sobre un segmento.
+
+    Tambien se usa para los snippets, con "decode" = bytes en lugar de pickle.loads.
+
+    """
+
+    def __init__(self, segment, table_off, count, decode=pickle.loads):
+        self.segment = segment
+        self.table_off = table_off
+        self.count = count
+        self.decode = decode
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __contains__(self, newid):
+        return 0 <= newid < self.count
+
+
+    def __getitem__(self, newid):
+        if(not 0 <= newid < self.count):
+            raise KeyError(newid)
+        start, end = self.segment.array('Q', self.table_off + newid * 8, 2)
+        return self.decode(self.segment.mm[start:end])
+
+
+    def get(self, newid, default=None):
+        if(newid not in self):
+            return default
+        return self[newid]
+
+
+    def keys(self):
+        return range(self.count)
+
+
+    __iter__ = keys
+
+
+    def items(self):
+        for newid in range(self.count):
+            yield newid, self[newid]
+
+
+    def values(self):
+        for newid in range(self.count):
+            yield self[newid]
@@ -0,0 +1,72 @@
+"""
+Almacen de textos para los snippets de SAR_Project.
+
+Al indexar se guarda, para cada noticia, su articulo en minusculas comprimido con zlib. Al
+mostrarlo se descomprime y se vuelve a partir en tokens con la expresion regular del indice,
+de forma que el token i es el de la posicion i de las posting lists (guardar tambien los
+offsets de los tokens hace el almacen un 25% mas grande y su construccion el triple de lenta,
+y tokenizar solo las noticias que se muestran es inmediato).
+
+Asi el snippet de una noticia se construye sin volver a leer el fichero original: las
+posiciones de los terminos de la consulta salen de sus posting lists y solo se extraen del
+texto los tokens de alrededor.
+
+"""
+
+import zlib
+
+
+# tokens que se muestran a cada lado de un termino de la consulta
+WIDTH = 5
+
+
+def encode(text):
+    """
+    Comprime el texto de un articulo.
+
+    return: bytes
+
+    """
+    return zlib.compress(text.lower().encode('utf-8'))
+
+
+
+def decode(data, tokenizer):
+    """
+    Tokens del articulo guardado con "encode".
+
+    param:  "data": bytes devueltos por "encode"
+            "tokenizer": expresion regular de un token (la misma que al indexar)
+
+    return: lista de tokens, el token i es el de la posicion i de las posting lists
+
+    """
+    return tokenizer.findall(zlib.decompress(data).decode('utf-8'))
+
+
+
+def build(article, positions, width=WIDTH, transform=None):
+    """
+    Construye el snippet de una noticia.
+
+    param:  "article": lista de tokens del articulo
+            "positions": posiciones de los terminos de la consulta en el articulo, ordenadas
+            "width": tokens que se muestran a cada lado de cada termino
+            "transform": funcion que se aplica a los tokens que se muestran (por ejemplo el stemmer)
+
+    return: lista de cadenas que forman el snippet
+
+    """
+    snippet = []
+    last_pos = 0
+    for pos in positions:
+        if(last_pos and pos > last_pos + width):
+            snippet.append(" ... ")
+        else:
+            snippet.append(' ')
+        tokens = article[max(last_pos, pos - width):pos + width]
+        snippet.append(' '.join(tokens if transform is None else map(transform, tokens)))
+        last_pos = pos
+    if(not last_pos):
+        snippet.append("No se han encontrado snippets en el cuerpo de la notícia ")
+    return snippet
@@ -0,0 +1,69 @@
+"""
+Vocabulario global de SAR_Project: cada termino (o stem) tiene un id entero, y las
+estructuras por noticia o por pareja de terminos (iindex, weight, freq) guardan ids
+en lugar de cadenas.
+
+"""
+
+
+class Vocabulary:
+    """
+    Biyeccion termino <-> id, con los ids asignados en orden de aparicion.
+
+        - terms: lista de terminos, el id de un termino es su posicion
+        - ids: {termino: id}
+
+    Solo se guarda la lista de terminos, el diccionario se reconstruye al cargarla.
+
+    """
+
+    def __init__(self, terms=()):
+        self.terms = []
+        self.ids = {}
+        for term in terms:
+            self.id(term)
+
+
+    def __len__(self):
+        return len(self.terms)
+
+
+    def __contains__(self, term):
+        return term in self.ids
+
+
+    def __getstate__(self):
+        return self.terms
+
+
+    def __setstate__(self, terms):
+        self.terms = terms
+        self.ids = dict(zip(terms, range(len(terms))))
+
+
+    def id(self, term):
+        """
+        Devuelve el id de "term", añadiendolo al vocabulario si no esta.
+
+        """
+        tid = self.ids.get(term)
+        if(tid is None):
+            tid = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return tid
+
+
+    def get(self, term, default=None):
+        """
+        Devuelve el id de "term", o "default" si no esta en el vocabulario.
+
+        """
+        return self.ids.get(term, default)
+
+
+    def term(self, tid):
+        """
+        Devuelve el termino con id "tid".
+
+        """
+        return self.terms[tid]